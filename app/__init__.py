@@ -15,10 +15,30 @@ def create_app(config_class=Config):
     app.config.from_object(config_class)
 
     app.db_app = init_firestore_db(config_class.GAC_KEY_PATH, app.name)
+    app.replica = None
+    if config_class.REPLICA_FILE:
+        from app.replica import Replica
+        app.replica = Replica(config_class.REPLICA_FILE, config_class.REPLICA_DELTA_FILE).load()
+        app.replica.watch(config_class.REPLICA_REFRESH)
+    elif config_class.GAME_WATCH:
+        from app.models import Game
+        Game.watch()
 
     login.init_app(app)
     bootstrap.init_app(app)
 
+    from app import instrumentation
+    instrumentation.init_app(app)
+
+    from app import fragments
+    fragments.init_app(app)
+
+    from app import compression
+    compression.init_app(app)
+
+    from app import http_cache
+    http_cache.init_app(app)
+
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
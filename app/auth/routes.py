@@ -1,7 +1,7 @@
 from flask import redirect, url_for, render_template, flash, request
 from flask_login import current_user, login_user, logout_user
 from werkzeug.urls import url_parse
-from app.models import User
+from app.models import load_user
 from app.auth import bp
 from app.auth.forms import LoginForm
 
@@ -16,7 +16,7 @@ def login():
     if not form.validate_on_submit():
         return render_template(template, title=title, form=form)
     # This is a POST request and the form is validated
-    user = User.query_first(username=form.username.data)
+    user = load_user(form.username.data)
     if user is None or not user.check_password(form.password.data):
         flash('Invalid username or password')
         return redirect(url_for('auth.login'))
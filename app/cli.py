@@ -1,8 +1,11 @@
 import click
+from time import sleep
 
-from app.main.game_transactions import Upload, invite_bid, Download
-from app.models import Game
+from app.main.game_transactions import Upload, invite_bid, Download, aggregate_bids, complete_bids
+from app.models import Game, Bid
+from app.simulation import Simulation
 from config import config
+from core.images import Thumbnails
 
 
 def register(app):
@@ -19,7 +22,10 @@ def register(app):
 
     @wc.command()
     @click.argument('upload_type')
-    def upload(upload_type):
+    @click.option('--upsert', is_flag=True, help='Players only. Write only the players added, changed or removed.')
+    @click.option('--dry-run', is_flag=True, help='With --upsert. Report the differences without writing them.')
+    @click.option('--file', 'file_name', default='wc.json', help='File to upload for all. A .snap file is a snapshot.')
+    def upload(upload_type, upsert, dry_run, file_name):
         """
         Upload data.
         UPLOAD_TYPE can be [users | players | scores |  all]\n
@@ -35,16 +41,35 @@ def register(app):
             click.echo('UPLOAD_TYPE can be [users | players | scores |  all]')
             return
 
+        if (upsert or dry_run) and upload_type != 'players':
+            click.echo('--upsert and --dry-run are only for players.')
+            return
+
         upload_data = Upload()
+        upload_data.upsert = upsert or dry_run
+        upload_data.dry_run = dry_run
         if upload_type == 'users':
             upload_data.file_name = config.USER_FILE_NAME
         if upload_type == 'all':
-            result = Upload.upload_all()
+            result = Upload.upload_all(file_name)
         else:
             result = upload_data(upload_type)
         if result != Upload.SUCCESS:
             click.echo(f'Error Code: {result}. Error in upload.')
             return
+        if upload_data.stats:
+            stats = upload_data.stats
+            click.echo(f"Uploaded {stats['users']} users in {stats['total_time']}s "
+                       f"({stats['users_per_second']} users/s). "
+                       f"Passwords hashed in {stats['hash_time']}s on {stats['workers']} processes.")
+        if upload_data.report:
+            report = upload_data.report
+            for change in ('added', 'changed', 'removed', 'kept'):
+                click.echo(f"{change.capitalize()}: {len(report[change])} {', '.join(report[change])}")
+            click.echo(f"Unchanged: {report['unchanged']}")
+            if dry_run:
+                click.echo('Dry run. Nothing has been written.')
+                return
         click.echo('Upload done!')
 
     @wc.command()
@@ -91,8 +116,7 @@ def register(app):
             if not game.bid_in_progress:
                 click.echo('Bid is NOT in progress.')
                 return
-            game.bid_in_progress = False
-            game.update()
+            game.update_fields(bid_in_progress=False)
             click.echo('Bidding has been paused.')
             return
 
@@ -103,18 +127,118 @@ def register(app):
             if game.player_to_bid == game.player_count:
                 click.echo('Bidding has not yet started. Use start option.')
                 return
-            game.bid_in_progress = True
-            game.update()
+            game.update_fields(bid_in_progress=True)
             click.echo('Bidding has been resumed.')
 
     @wc.command()
-    def download():
+    @click.option('--interval', default=0.5, help='Seconds to wait between checks of the lot in bidding.')
+    def aggregate(interval):
+        """
+        Close lots from the bid entries till bidding is complete.\n
+        Run a single instance of this while bidding with BID_INTAKE = 'entries'.\n
+        """
+        env_banner()
+
+        while True:
+            result = aggregate_bids()
+            if result == Bid.ERROR_NO_MORE_PLAYERS:
+                click.echo('Bidding is complete')
+                return
+            if isinstance(result, Bid):
+                game = Game.read()
+                click.echo(f'{game.last_player} - {game.last_winner} {game.last_price}. '
+                           f'{result.player_name} invited to bid.')
+                continue
+            sleep(interval)
+
+    @wc.command('shard-counters')
+    def shard_counters_command():
+        """
+        Move the game counters saved in the game document to the sharded counters. Run once after upgrading.
+        """
+        env_banner()
+
+        game = Game.read()
+        if not game:
+            click.echo('Init the game first by uploading player data.')
+            return
+        unsharded = game.shard_counters()
+        click.echo(f"Counters sharded: {', '.join(unsharded) if unsharded else 'none'}.")
+
+    @wc.command('complete-bids')
+    def complete_bids_command():
+        """
+        Mark the lots closed before the bid history was saved in display form as complete.
+        """
+        env_banner()
+
+        click.echo(f'{complete_bids()} lots marked as complete.')
+
+    @wc.command()
+    @click.option('--delta', is_flag=True, help='Append only the changes since the last download to wc-delta.jsonl.')
+    @click.option('--compact', is_flag=True, help='Fold wc-delta.jsonl into the download.')
+    @click.option('--file', 'file_name', default='wc.json', help='File to download to. A .snap file is a snapshot.')
+    def download(delta, compact, file_name):
         """
-        Download all data in json format.
+        Download all data in json format or as a compressed snapshot.
         """
         env_banner()
 
-        download_data = Download()
+        download_data = Download(file_name)
+        if delta:
+            changed = download_data.delta()
+            click.echo(f'{changed} changed documents appended to {download_data.delta_file}.')
+        if compact:
+            download_data.compact()
+            click.echo(f'{download_data.delta_file} folded into {download_data.file_name}.')
+        if delta or compact:
+            return
         download_data()
         click.echo('Download done.')
 
+    @wc.command()
+    def thumbnails():
+        """
+        Resize the player images in app/static and save them with the hash of their content in the file name.\n
+        Requires Pillow. Run it after the images are changed and deploy app/static/images.\n
+        """
+        thumbnails_data = Thumbnails()
+        result = thumbnails_data()
+        if result == Thumbnails.ERROR_NO_PILLOW:
+            click.echo('Install Pillow to build the thumbnails (pip install Pillow).')
+            return
+        if result != Thumbnails.SUCCESS:
+            click.echo(f'Error Code: {result}. Error in thumbnails.')
+            return
+        report = thumbnails_data.report
+        click.echo(f"{report['images']} images resized from {report['original_bytes']} to "
+                   f"{report['thumbnail_bytes']} bytes. {report['removed']} old thumbnails removed.")
+
+    @wc.command()
+    @click.option('--users', default=10, help='Number of users in the league.')
+    @click.option('--players', default=150, help='Number of players to auction.')
+    @click.option('--bidders', default=None, type=int, help='Concurrent bidders. Defaults to the number of users.')
+    @click.option('--seed', default=None, type=int, help='Seed to generate the same league again.')
+    @click.option('--intake', default='transaction', type=click.Choice(Simulation.INTAKES),
+                  help='Bid intake. Refer BID_INTAKE in config.')
+    @click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+    def simulate(users, players, bidders, seed, intake, yes):
+        """
+        Simulate a complete auction on a synthetic league.\n
+        ALL users, players, bids and the game are replaced. Run it on DEV or a local/emulated database.\n
+        """
+        env_banner()
+
+        if not yes and not click.confirm('All data will be replaced with a synthetic league. Continue?'):
+            return
+
+        simulation = Simulation(users, players, bidders, seed, intake)
+        simulation.generate()
+        click.echo(f'Generated {users} users and {players} players. Auction started.')
+        stats = simulation.run()
+        click.echo(f"{stats['lots']} lots in {stats['seconds']}s ({stats['lots_per_second']} lots/s) "
+                   f"with {stats['bidders']} bidders and {stats['intake']} intake.")
+        click.echo(f"{stats['bids']} bids. Latency p50 {stats['p50']}ms, p95 {stats['p95']}ms, p99 {stats['p99']}ms.")
+        for name, counts in stats['transactions'].items():
+            click.echo(f"{name}: {counts['calls']} calls, {counts['retries']} retries.")
+        click.echo(f"Results: {stats['results']}")
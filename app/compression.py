@@ -0,0 +1,78 @@
+import gzip
+import hashlib
+from threading import Lock
+from cachetools import LRUCache
+from flask import request, current_app
+from metrics import cache_requests
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIMETYPES = ('text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript')
+
+
+class Compressor:
+    # Compressed bodies by encoding and the hash of the body. The same page or json sent again (like the game status
+    # on every poll) is not compressed again. The least recently used bodies are evicted after max_bytes.
+    def __init__(self, max_bytes, level):
+        self.cache = LRUCache(maxsize=max_bytes, getsizeof=len)
+        self.lock = Lock()
+        self.level = level
+
+    @staticmethod
+    def encoding():
+        # brotli if the client prefers it or as much as gzip and brotli is installed
+        gzip_quality = request.accept_encodings['gzip']
+        brotli_quality = request.accept_encodings['br'] if brotli else 0
+        if brotli_quality and brotli_quality >= gzip_quality:
+            return 'br'
+        if gzip_quality:
+            return 'gzip'
+        return None
+
+    def compress(self, data, encoding, cacheable=True):
+        key = (encoding, hashlib.sha1(data).digest())
+        with self.lock:
+            body = self.cache.get(key)
+        cache_requests.inc(cache='compressed', result='miss' if body is None else 'hit')
+        if body is not None:
+            return body
+        if encoding == 'br':
+            body = brotli.compress(data, quality=min(self.level, 11))
+        else:
+            body = gzip.compress(data, compresslevel=self.level)
+        if cacheable:
+            with self.lock:
+                try:
+                    self.cache[key] = body
+                except ValueError:
+                    # Larger than the cache
+                    pass
+        return body
+
+    def after_request(self, response):
+        if response.mimetype not in MIMETYPES or response.direct_passthrough or response.is_streamed:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code != 200 or 'Content-Encoding' in response.headers:
+            return response
+        encoding = self.encoding()
+        if not encoding:
+            return response
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(self.compress(data, encoding, not response.cache_control.no_store))
+        response.headers['Content-Encoding'] = encoding
+        # The compressed body is another representation of the same page (refer app.http_cache)
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def init_app(app):
+    app.compressor = Compressor(app.config['COMPRESS_CACHE_BYTES'], app.config['COMPRESS_LEVEL'])
+    app.after_request(app.compressor.after_request)
@@ -0,0 +1,42 @@
+from threading import Lock
+from cachetools import LRUCache
+from flask import render_template, current_app, g
+from jinja2 import Markup
+from metrics import cache_requests
+
+
+class FragmentCache:
+    # Rendered html of templates in a page by key. It is valid for a revision of the game (refer Game.revision) and
+    # is cleared when the revision changes. The least recently used fragments are evicted after max_bytes.
+    def __init__(self, max_bytes):
+        self.cache = LRUCache(maxsize=max_bytes, getsizeof=len)
+        self.lock = Lock()
+        self.revision = None
+
+    def render(self, template, key, **context):
+        revision = g.game.revision
+        key = (template,) + tuple(key)
+        with self.lock:
+            if revision != self.revision:
+                self.cache.clear()
+                self.revision = revision
+            html = self.cache.get(key)
+        cache_requests.inc(cache='fragment', result='miss' if html is None else 'hit')
+        if html is None:
+            html = render_template(template, **context)
+            with self.lock:
+                if revision == self.revision:
+                    try:
+                        self.cache[key] = html
+                    except ValueError:
+                        # Larger than the cache
+                        pass
+        return Markup(html)
+
+
+def init_app(app):
+    app.fragments = FragmentCache(app.config['FRAGMENT_CACHE_BYTES'])
+
+
+def render_fragment(template, key, **context):
+    return current_app.fragments.render(template, key, **context)
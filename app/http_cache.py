@@ -0,0 +1,58 @@
+import hashlib
+import json
+from datetime import datetime
+from flask import current_app, request, session, g, Response
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+from core.images import IMAGES_FOLDER
+
+# A year. The thumbnails have the hash of their content in the file name (refer core.images).
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def init_app(app):
+    app.after_request(immutable_images)
+
+
+def immutable_images(response):
+    # Static files served by flask. On app engine they are served as per app.yaml.
+    if request.endpoint != 'static' or response.status_code != 200:
+        return response
+    if not (request.view_args or dict()).get('filename', '').startswith(IMAGES_FOLDER + '/'):
+        return response
+    response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return response
+
+
+def validators(updated):
+    # The page also shows the user and the status of the game. The time of the documents is to the second.
+    last_modified = datetime.utcfromtimestamp(int(updated.timestamp())) if updated else None
+    page = [last_modified.isoformat() if last_modified else None, current_user.get_id(), g.game.to_dict()]
+    etag = hashlib.sha1(json.dumps(page, sort_keys=True, default=str).encode()).hexdigest()
+    return etag, last_modified
+
+
+def not_modified(updated):
+    # Returns a 304 response if the page with the documents updated at this time is current in the browser.
+    # Otherwise returns None and the validators are set on the rendered page by cache_headers.
+    g.validators = validators(updated)
+    if session.get('_flashes'):
+        return None
+    etag, last_modified = g.validators
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return cache_headers(Response(status=304))
+
+
+def cache_headers(response):
+    etag, last_modified = g.validators
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    if g.game.player_to_bid:
+        # The auction is on. The browser checks with the server before a cached page is shown.
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.max_age = current_app.config['HTTP_CACHE_MAX_AGE']
+    return response
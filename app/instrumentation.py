@@ -0,0 +1,80 @@
+import hmac
+import json
+import logging
+from time import perf_counter
+from flask import g, request, current_app, abort, Response
+from firestore_model import start_request_stats, end_request_stats, current_request_stats, firestore_stats, \
+    transaction_counts
+from metrics import registry
+
+STATS_HEADER = 'X-Firestore-Stats'
+
+requests_total = registry.counter('wc_requests_total', 'Requests by endpoint and status.')
+request_seconds = registry.histogram('wc_request_seconds', 'Time to serve a request by endpoint.')
+registry.gauge('wc_firestore_calls_total', 'Firestore round trips by operation.',
+               lambda: [({'operation': operation}, calls)
+                        for operation, calls in firestore_stats()['operations'].items()], 'counter')
+registry.gauge('wc_transaction_calls_total', 'Calls of each transaction.',
+               lambda: [({'transaction': name}, counts['calls'])
+                        for name, counts in transaction_counts().items()], 'counter')
+registry.gauge('wc_transaction_retries_total', 'Retries of each transaction due to contention.',
+               lambda: [({'transaction': name}, counts['retries'])
+                        for name, counts in transaction_counts().items()], 'counter')
+
+
+def init_app(app):
+    # Firestore calls of each request are sent in a response header and logged as a json line (refer REQUEST_LOG)
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+    app.context_processor(lambda: {'firestore_request_stats': firestore_request_stats})
+    # Outside the main blueprint so that the game is not read on every scrape
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    if app.config.get('REQUEST_LOG'):
+        app.logger.setLevel(logging.INFO)
+
+
+def before_request():
+    g.request_start = perf_counter()
+    start_request_stats()
+
+
+def after_request(response):
+    endpoint = request.endpoint or 'none'
+    requests_total.inc(endpoint=endpoint, status=response.status_code)
+    if 'request_start' in g:
+        request_seconds.observe(perf_counter() - g.request_start, endpoint=endpoint)
+    stats = end_request_stats()
+    if not stats or not current_app.config.get('REQUEST_LOG'):
+        return response
+    summary = stats.to_dict()
+    response.headers[STATS_HEADER] = f"calls={summary['calls']}; bytes={summary['bytes']}; time={summary['time']}ms"
+    current_app.logger.info(json.dumps({
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration': round((perf_counter() - g.request_start) * 1000, 1),
+        'firestore': summary,
+    }))
+    return response
+
+
+def teardown_request(exception):
+    # after_request is not called on an unhandled exception
+    end_request_stats()
+
+
+def firestore_request_stats():
+    # Firestore calls made so far in the current request (shown at the bottom of each page in TESTING)
+    stats = current_request_stats()
+    return stats.to_dict() if stats else None
+
+
+def metrics():
+    # Prometheus text format. Only for a scraper with the token (refer METRICS_TOKEN) or from an allowed address.
+    token = current_app.config.get('METRICS_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    authorized = bool(token) and hmac.compare_digest(authorization, f'Bearer {token}')
+    if not authorized and request.remote_addr not in current_app.config.get('METRICS_ALLOWED_IPS', ()):
+        abort(403)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -1,200 +1,177 @@
 import csv
 import json
+import multiprocessing
+import os
 import random
-from firebase_admin import firestore
-from firestore_model import FirestorePage
-from app.models import Game, User, Player, Bid, Country
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from firestore_model import FirestorePage, transactional, stamp, encode_timestamp, decode_timestamp
+from metrics import registry
+from snapshot import is_snapshot, write_snapshot, read_snapshot, load_snapshot
+from app.models import Game, User, Player, Bid, BidEntry, Roster, Country
+from core.scores import init_user_points, sync_player_user_points
 
+bid_submit_seconds = registry.histogram('wc_bid_submit_seconds', 'Time to accept a bid including closing the lot.')
+lot_close_seconds = registry.histogram('wc_lot_close_seconds', 'Time to settle a lot and invite the next one.')
 
-@firestore.transactional
+
+@transactional
 def purchase_player_transaction(transaction, player, user=None, amount=0):
-    player_ref, player_snapshot = player.get_doc(transaction)
-    user_ref = None
-    user_snapshot = None
+    player = Player.read_tx(transaction, player.doc_id)
     user_updates = None
     if user:
-        user_ref, user_snapshot = user.get_doc(transaction)
-        if not user_snapshot:
+        user = User.read_tx(transaction, user.doc_id)
+        if not user:
             return False
-    game = Game.read()
-    if not game:
-        game = Game.init_game()
-    game_ref, game_snapshot = game.get_doc(transaction)
-    if not player_snapshot or not game_snapshot:
+    game = Game.read_tx(transaction)
+    roster = Roster.read_tx(transaction)
+    if not player or not game:
         return False
-    if user_snapshot:
+    if user:
         player_updates = {
             'status': player.PURCHASED,
-            'owner_username': user_snapshot.get('username'),
+            'owner_username': user.username,
             'owner': {
-                'name': user_snapshot.get('name'),
-                'points': user_snapshot.get('points') + player_snapshot.get('score'),
-                'color': user_snapshot.get('color'),
-                'bg_color': user_snapshot.get('bg_color'),
+                'name': user.name,
+                'points': user.points + player.score,
+                'color': user.color,
+                'bg_color': user.bg_color,
             },
             'price': amount,
         }
         user_updates = {
-            'balance': user_snapshot.get('balance') - amount,
-            'player_count': user_snapshot.get('player_count') + 1,
+            'balance': user.balance - amount,
+            'player_count': user.player_count + 1,
         }
-        last_winner = user_snapshot.get('username').upper()
+        last_winner = user.username.upper()
     else:
         player_updates = {
             'status': player.UNSOLD
         }
         last_winner = 'Unsold'
         amount = 0
-    player_value = Player.query_first(name=player_snapshot.get('name')).value
+    counter_updates = [
+        Game.counters['total_balance'].increment(transaction, -amount),
+        Game.counters['player_to_bid'].increment(transaction, -1),
+        Game.counters['remaining_value'].increment(transaction, -player.value),
+    ]
+    counter_updates.extend(Game.counters['user_to_bid'].reset(0))
     game_updates = {
-        'total_balance': game_snapshot.get('total_balance') - amount,
         'player_in_bidding': None,
-        'player_to_bid': game_snapshot.get('player_to_bid') - 1,
-        'remaining_value': game_snapshot.get('remaining_value') - player_value,
-        'user_to_bid': 0,
-        'last_player': player_snapshot.get('name'),
+        'last_player': player.name,
         'last_winner': last_winner,
         'last_price': amount,
         'bid_in_progress': False,
+        'revision': Game.new_revision(),
     }
     if user_updates:
-        transaction.update(user_ref, user_updates)
-    transaction.update(player_ref, player_updates)
-    transaction.update(game_ref, game_updates)
+        transaction.update(user.get_doc()[0], stamp(user_updates))
+        if roster:
+            roster.balances[user.username] = user_updates['balance']
+            transaction.update(roster.get_doc()[0], stamp({'balances': roster.balances}))
+    transaction.update(player.get_doc()[0], stamp(player_updates))
+    transaction.update(game.get_doc()[0], stamp(game_updates))
+    for shard_ref, shard_dict in counter_updates:
+        transaction.set(shard_ref, shard_dict)
     return True
 
 
+def init_auction():
+    # The game and the roster are created before a transaction starts. A transaction may be retried so it only reads
+    # and writes the documents in it.
+    if not Game.read():
+        Game.init_game()
+    if not Roster.read():
+        Roster.build()
+
+
 def purchase_player(player, user, amount):
+    init_auction()
     transaction = Player.get_transaction()
     if purchase_player_transaction(transaction, player, user, amount):
-        return update_user_points_transaction(transaction, user)
+        result = update_user_points_transaction(transaction, user)
+        # The points of the players of the user have changed after the purchase
+        Game().bump_revision()
+        User.uncache(user.username)
+        return result
     return False
 
 
-@firestore.transactional
+@transactional
 def update_user_points_transaction(transaction, user):
-    players = Player.query(owner_username=user.username)
-    owning_players = list()
-    points = 0
-    for player in players:
-        player_ref, player_snapshot = player.get_doc(transaction)
-        points += player_snapshot.get('score')
-        player_map = {
-            'player_ref': player_ref,
-            'owner': player_snapshot.get('owner'),
-        }
-        owning_players.append(player_map)
+    players = Player.query_tx(transaction, owner_username=user.username)
+    points = sum(player.score for player in players)
     if points == 0:
         return False
     # Update the user points
-    user_ref, user_snapshot = user.get_doc(transaction)
+    user_ref, _ = user.get_doc()
     user_updates = {
         'points': points,
     }
-    transaction.update(user_ref, user_updates)
+    transaction.update(user_ref, stamp(user_updates))
     # Update points of each player owned by user
-    for player_map in owning_players:
-        owner = player_map['owner']
+    for player in players:
+        owner = player.owner
         owner['points'] = points
         player_updates = {
             'owner': owner
         }
-        transaction.update(player_map['player_ref'], player_updates)
+        transaction.update(player.get_doc()[0], stamp(player_updates))
     return True
 
 
-def init_user_points():
-    users = User.get_all()
-    User.init_batch()
-    for user in users:
-        user.points = 0
-        user.update_batch()
-    User.commit_batch()
-
-
-def sync_player_user_points():
-    # This function needs to be called after scores for the players has been updated
-    users = User.get_all()
-    User.init_batch()
-    for user in users:
-        owned_players = Player.query(owner_username=user.username)
-        if owned_players:
-            user.points = sum([player.score for player in owned_players])
-            user.update_batch()
-    User.commit_batch()
-    players = Player.get_all()
-    Player.init_batch()
-    for player in players:
-        if isinstance(player.owner, dict) and 'points' in player.owner:
-            player.owner['points'] = next((user.points for user in users if user.username == player.owner_username), 0)
-            player.update_batch()
-    Player.commit_batch()
-
-
-@firestore.transactional
+@transactional
 def invite_bid_transaction(transaction, player):
-    player_ref, player_snapshot = player.get_doc(transaction)
-    game = Game.read()
-    if not game:
-        game = Game.init_game()
-    game_ref, game_snapshot = game.get_doc(transaction)
+    player = Player.read_tx(transaction, player.doc_id)
+    game = Game.read_tx(transaction)
+    roster = Roster.read_tx(transaction)
+    if not game or not roster:
+        return Bid.ERROR_SYSTEM
     # Validate
-    if not player_snapshot or player_snapshot.get('status') != Player.AVAILABLE:
+    if not player or player.status != Player.AVAILABLE:
         return Bid.ERROR_PLAYER_NOT_AVAILABLE
-    if game_snapshot.get('bid_in_progress'):
+    if game.bid_in_progress:
         return Bid.ERROR_BID_IN_PROGRESS
-    bid = Bid(player_snapshot.get('name'))
-    # Creation not in transaction is fine since it will only create the bid once
-    bid = bid.create()
+    # Auto bid for zero balance
+    zero_balance_usernames = roster.zero_balance_usernames
+    bid = Bid(player.name, player.bid_order)
+    bid.bid_map = [{'username': username, 'amount': Bid.NO_BALANCE} for username in zero_balance_usernames]
     player_updates = {
         'status': Player.BIDDING
     }
     game_updates = {
         'bid_in_progress': True,
-        'user_to_bid': game_snapshot.get('user_count'),
-        'player_in_bidding': player_snapshot.get('name'),
-        'users_to_bid': [user.username for user in User.get_all()]
+        'player_in_bidding': player.name,
+        'users_to_bid': [username for username in roster.usernames if username not in zero_balance_usernames],
+        'revision': Game.new_revision(),
     }
-    # Auto bid for zero balance
-    zero_balance_users = User.query(balance=0)
-    if zero_balance_users:
-        bid_ref, bid_snapshot = bid.get_doc(transaction)
-        bid_updates = {
-            'bid_map': bid_snapshot.get('bid_map'),
-        }
-        for user in zero_balance_users:
-            zero_bid = {
-                'username': user.username,
-                'amount': Bid.NO_BALANCE,
-            }
-            bid_updates['bid_map'].append(zero_bid),
-            game_updates['user_to_bid'] -= 1
-            game_updates['users_to_bid'].remove(user.username)
-        transaction.update(bid_ref, bid_updates)
-    transaction.update(player_ref, player_updates)
-    transaction.update(game_ref, game_updates)
+    transaction.set(bid.get_doc()[0], stamp(bid.to_dict()))
+    transaction.update(player.get_doc()[0], stamp(player_updates))
+    transaction.update(game.get_doc()[0], stamp(game_updates))
+    for shard_ref, shard_dict in Game.counters['user_to_bid'].reset(game.user_count - len(zero_balance_usernames)):
+        transaction.set(shard_ref, shard_dict)
     return Bid.SUCCESS
 
 
-@firestore.transactional
+@transactional
 def accept_bid_transaction(transaction, bid, user, amount):
     if amount != Bid.PASS and amount < 1:
         return Bid.ERROR_INVALID_AMOUNT
     if not bid:
         return Bid.ERROR_SYSTEM
-    bid_ref, bid_snapshot = bid.get_doc(transaction)
-    game = Game.read()
-    if not game:
-        game = Game.init_game()
-    game_ref, game_snapshot = game.get_doc(transaction)
-    # Validate (Does NOT validate if the user exists in the db)
-    if not bid_snapshot or not user or not user.username:
+    lot = Bid.read_tx(transaction, bid.doc_id)
+    game = Game.read_tx(transaction)
+    if not lot or not game or not user or not user.username:
         return Bid.ERROR_SYSTEM
-    if user.username not in game_snapshot.get('users_to_bid'):
+    if user.username not in game.users_to_bid:
         return Bid.ERROR_ALREADY_BID
+    # The user of the request may be from the cache of another process. The balance is validated with the latest.
+    user = User.read_tx(transaction, user.doc_id)
+    if not user:
+        return Bid.ERROR_SYSTEM
     if user.balance < amount:
         return Bid.ERROR_NO_BALANCE
-    player = Player.query_first(name=bid.player_name)
+    player = Player.read_tx(transaction, Player.name_to_id(lot.player_name))
     if not player:
         return Bid.ERROR_PLAYER_NOT_FOUND
     if player.status != Player.BIDDING:
@@ -203,62 +180,126 @@ def accept_bid_transaction(transaction, bid, user, amount):
         'username': user.username,
         'amount': amount,
     }
-    bid_list = [user_bid]
-    if bid_snapshot.get('bid_map'):
-        bid_list = bid_snapshot.get('bid_map')
-        bid_list.append(user_bid)
-    user_list = game_snapshot.get('users_to_bid')
+    bid_list = lot.bid_map or list()
+    bid_list.append(user_bid)
+    user_list = game.users_to_bid
     if user_list:
         user_list.remove(user.username)
     bid_updates = {
         'bid_map': bid_list,
     }
     game_updates = {
-        'user_to_bid': game_snapshot.get('user_to_bid') - 1,
         'users_to_bid': user_list,
     }
-    transaction.update(bid_ref, bid_updates)
-    transaction.update(game_ref, game_updates)
+    shard_ref, shard_dict = Game.counters['user_to_bid'].increment(transaction, -1)
+    transaction.update(lot.get_doc()[0], stamp(bid_updates))
+    transaction.update(game.get_doc()[0], stamp(game_updates))
+    transaction.set(shard_ref, shard_dict)
     return Bid.SUCCESS
 
 
 def accept_bid(bid, user, amount=Bid.PASS):
-    transaction = Bid.get_transaction()
-    bid_result = accept_bid_transaction(transaction, bid, user, amount)
-    if bid_result <= 0:
-        return bid_result
-    bid.refresh()
-    game = Game.read()
-    if not bid.is_bid_complete(game.user_count):
+    with bid_submit_seconds.time(intake='transaction'):
+        transaction = Bid.get_transaction()
+        bid_result = accept_bid_transaction(transaction, bid, user, amount)
+        if bid_result <= 0:
+            return bid_result
+        bid.refresh()
+        game = Game.read()
+        if not bid.is_bid_complete(game.user_count):
+            return Bid.SUCCESS
+        return settle_bid(bid, transaction)
+
+
+def submit_bid(bid, user, amount=Bid.PASS):
+    # Entries intake - the bid is a single write of a new document. Neither the lot nor the game is read.
+    # The lot is closed by aggregate_bids.
+    if amount != Bid.PASS and amount < 1:
+        return Bid.ERROR_INVALID_AMOUNT
+    if not bid or not user or not user.username:
+        return Bid.ERROR_SYSTEM
+    # The user may be from the cache (refer User.read_cached). An amount more than the latest balance is saved as
+    # NO_BALANCE when the entry is folded into the lot.
+    if user.balance < amount:
+        return Bid.ERROR_NO_BALANCE
+    with bid_submit_seconds.time(intake='entries'):
+        if not BidEntry(bid.player_name, user.username, amount).create():
+            return Bid.ERROR_ALREADY_BID
+    return Bid.SUCCESS
+
+
+def aggregate_bids():
+    # Entries intake - folds the entries of the lot in bidding into the lot and closes it once every user has bid.
+    # Only a single aggregator should run (refer flask wc aggregate) since it is the only writer of the lot.
+    # Returns the next bid if the lot was closed.
+    # It is called in a loop while bidding. The game and the lot are each read once and the counters are only read
+    # if no lot is in bidding.
+    game = Game.read_document()
+    if not game:
+        return Bid.ERROR_NO_MORE_PLAYERS
+    if not game.bid_in_progress or not game.player_in_bidding:
+        game.sum_counters()
+        return Bid.ERROR_NO_MORE_PLAYERS if game.player_to_bid == 0 else Bid.ERROR_PLAYER_NOT_INVITED_TO_BID
+    bid = Bid.read(Player.name_to_id(game.player_in_bidding))
+    if not bid:
+        return Bid.ERROR_SYSTEM
+    entries = [entry for entry in BidEntry.query(player_name=bid.player_name)
+               if entry.username in game.users_to_bid and not bid.has_bid(entry.username)]
+    if not entries:
         return Bid.SUCCESS
-    # Determine Winner
-    player = Player.query_first(name=bid.player_name)
-    winning_bid = max(bid.bid_map, key=lambda bid_dict: bid_dict['amount'])
-    if winning_bid['amount'] < 1:
-        purchase_player_transaction(transaction, player)
-    else:
-        winning_bids = [bid_dict for bid_dict in bid.bid_map if bid_dict['amount'] == winning_bid['amount']]
-        if len(winning_bids) > 1:
-            winning_index = random.randrange(0, len(winning_bids))
-            winning_bid = winning_bids[winning_index]
-        winner = User.query_first(username=winning_bid['username'])
-        purchase_player_transaction(transaction, player, winner, winning_bid['amount'])
-        bid.winner = winning_bid['username']
-        bid.winning_price = winning_bid['amount']
+    usernames = [entry.username for entry in entries]
+    # The balance was validated with the user of the request. Validate it again with the latest one.
+    balances = {user.username: user.balance for user in User.read_many(usernames)}
+    for entry in entries:
+        amount = entry.amount if entry.amount <= balances.get(entry.username, 0) else Bid.NO_BALANCE
+        bid.bid_map.append({'username': entry.username, 'amount': amount})
+    if bid.is_bid_complete(game.user_count):
+        return settle_bid(bid)
+    # The lot is saved before the game so that an entry is never folded twice
+    bid.update()
+    users_to_bid = [username for username in game.users_to_bid if username not in usernames]
+    game.update_fields(users_to_bid=users_to_bid, user_to_bid=len(users_to_bid))
+    return Bid.SUCCESS
+
+
+def settle_bid(bid, transaction=None):
+    # Determine the winner of a complete lot, save the lot and invite the next player
+    with lot_close_seconds.time():
+        if transaction is None:
+            transaction = Bid.get_transaction()
+        # Only the doc_id is required. The player and the winner are read in the transaction.
+        player = Player(bid.player_name)
+        winning_bid = max(bid.bid_map, key=lambda bid_dict: bid_dict['amount'])
+        if winning_bid['amount'] < 1:
+            purchase_player_transaction(transaction, player)
+        else:
+            winning_bids = [bid_dict for bid_dict in bid.bid_map if bid_dict['amount'] == winning_bid['amount']]
+            if len(winning_bids) > 1:
+                winning_index = random.randrange(0, len(winning_bids))
+                winning_bid = winning_bids[winning_index]
+            winner = User(winning_bid['username'])
+            purchase_player_transaction(transaction, player, winner, winning_bid['amount'])
+            User.uncache(winner.username)
+            bid.winner = winning_bid['username']
+            bid.winning_price = winning_bid['amount']
+        # Save the closed lot in its display form for the bid history
+        bid.bid_map.sort(key=lambda item: item['username'])
+        bid.complete = True
         bid.update()
-    # Invite another bid
-    return invite_bid()
+        # Invite another bid
+        return invite_bid()
 
 
 def invite_bid():
     available_players = available_players_view()
     if not available_players:
         return Bid.ERROR_NO_MORE_PLAYERS
+    init_auction()
     transaction = Bid.get_transaction()
     bid_result = invite_bid_transaction(transaction, available_players[0])
     if bid_result != Bid.SUCCESS:
         return bid_result
-    bid = Bid.query_first(player_name=available_players[0].name)
+    bid = Bid.read(available_players[0].doc_id)
     if not bid:
         return Bid.ERROR_SYSTEM
     return bid
@@ -272,14 +313,14 @@ def player_view(player_id):
     return Player.read(player_id)
 
 
-def available_players_view(per_page=None, start='', end='', direction=FirestorePage.NEXT_PAGE):
+def player_updated(player_id):
+    return Player.last_updated(player_id)
+
+
+def available_players_view(per_page=None, cursor='', direction=FirestorePage.NEXT_PAGE):
     if per_page is None or direction not in [FirestorePage.NEXT_PAGE, FirestorePage.PREV_PAGE]:
         return Player.order_by('bid_order', query=({'status': Player.AVAILABLE}))
-    page = FirestorePage(per_page)
-    if start:
-        page.current_start = Player.read(start)
-    if end:
-        page.current_end = Player.read(end)
+    page = FirestorePage(per_page, cursor)
     page.want = direction
     page = Player.order_by('bid_order', query=({'status': Player.AVAILABLE}), page=page)
     if len(page.items) == 0:
@@ -307,6 +348,10 @@ def purchased_players_view(username):
     return data
 
 
+def purchased_players_updated(username):
+    return Player.last_updated(owner_username=username)
+
+
 def search_players_view(tags):
     if isinstance(tags, str):
         tags = [tags.strip()]
@@ -357,30 +402,37 @@ def search_players_view(tags):
     return data
 
 
-def bids_view(per_page=None, start='', end='', direction=FirestorePage.NEXT_PAGE):
+def bids_view(per_page=None, cursor='', direction=FirestorePage.NEXT_PAGE):
+    # Only closed lots are shown. They are saved sorted with the winner at settlement (refer accept_bid).
     if per_page is None or direction not in [FirestorePage.NEXT_PAGE, FirestorePage.PREV_PAGE]:
-        bids = Bid.order_by(('bid_order', Bid.ORDER_DESCENDING))
-        if not bids[0].is_bid_complete(Game.read().user_count):
-            bids = bids[1:]
-        for bid in bids:
-            bid.bid_map.sort(key=lambda item: item['username'])
-        return bids
-    page = FirestorePage(per_page)
-    if start:
-        page.current_start = Bid.read(start)
-    if end:
-        page.current_end = Bid.read(end)
+        return Bid.order_by(('bid_order', Bid.ORDER_DESCENDING), query={'complete': True})
+    page = FirestorePage(per_page, cursor)
     page.want = direction
-    page = Bid.order_by(('bid_order', Bid.ORDER_DESCENDING), page=page)
+    page = Bid.order_by(('bid_order', Bid.ORDER_DESCENDING), query={'complete': True}, page=page)
     if len(page.items) == 0:
         return None
-    if not page.items[0].is_bid_complete(Game.read().user_count):
-        page.items = page.items[1:]
-    for bid in page.items:
-        bid.bid_map.sort(key=lambda item: item['username'])
     return page
 
 
+def complete_bids():
+    # Lots closed before they were saved in display form have no complete flag and are not shown by bids_view.
+    # Marks the lots in which every user has bid as complete. Returns the number of lots marked.
+    game = Game.read()
+    if not game:
+        return 0
+    count = 0
+    Bid.init_batch()
+    for bid in Bid.get_all():
+        if bid.complete or not bid.is_bid_complete(game.user_count):
+            continue
+        bid.bid_map.sort(key=lambda item: item['username'])
+        bid.complete = True
+        bid.update_batch()
+        count += 1
+    Bid.commit_batch()
+    return count
+
+
 class Upload:
     ACCEPTED_TYPES = [
         'users',
@@ -393,6 +445,9 @@ class Upload:
         'players': True,
         'scores': False,
     }
+    # Fields of a player from the players file
+    PLAYER_FIELDS = ['name', 'country', 'rank', 'color', 'bg_color', 'country_code', 'type', 'tags', 'bid_order',
+                     'matches', 'runs', 'catches', 'balls', 'wickets']
     SUCCESS = 0
     ERROR_NOT_VALID_TYPE = -1
     ERROR_FILE_NOT_FOUND = -2
@@ -402,6 +457,15 @@ class Upload:
         self.type = upload_type
         self.data_list = None
         self.file_name = None
+        # Number of processes to hash passwords. Defaults to the number of cores.
+        self.workers = None
+        # Throughput of the last upload
+        self.stats = dict()
+        # Players are compared with the stored players and only the differences are written (refer upsert_players).
+        # With dry_run nothing is written. The differences are in the report.
+        self.upsert = False
+        self.dry_run = False
+        self.report = dict()
 
     def __call__(self, upload_type=None):
         if upload_type is not None:
@@ -422,16 +486,34 @@ class Upload:
         # Index of columns         0            1        2          3         4
         if self.data_list[0] != ['username', 'name', 'password', 'color', 'bg_color']:
             return self.ERROR_INVALID_HEADER
+        start = perf_counter()
+        user_rows = self.data_list[1:]
+        workers = self.workers or os.cpu_count() or 1
+        chunk_size = max(1, len(user_rows) // (workers * 4))
+        # The workers are spawned. A fork of a process with a grpc channel open (the firestore client) is not safe.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            password_hashes = list(executor.map(User.hash_password, [user_row[2] for user_row in user_rows],
+                                                chunksize=chunk_size))
+        hash_time = perf_counter() - start
         User.delete_all()
         User.init_batch()
-        for user_row in self.data_list[1:]:
+        for user_row, password_hash in zip(user_rows, password_hashes):
             user = User(name=user_row[1].strip(), username=user_row[0].strip())
-            user.set_password(user_row[2])
+            user.password_hash = password_hash
             user.color = user_row[3].strip().lower()
             user.bg_color = user_row[4].strip().lower()
             user.update_batch()
         User.commit_batch()
+        User.uncache()
         Game.init_game()
+        total_time = perf_counter() - start
+        self.stats = {
+            'users': len(user_rows),
+            'workers': workers,
+            'hash_time': round(hash_time, 2),
+            'total_time': round(total_time, 2),
+            'users_per_second': round(len(user_rows) / total_time, 1) if total_time > 0 else 0.0,
+        }
         return self.SUCCESS
 
     def upload_players(self):
@@ -439,129 +521,228 @@ class Upload:
         hdr = ['name', 'country', 'type', 'tags', 'bid_order', 'matches', 'runs', 'catches', 'balls', 'wickets']
         if self.data_list[0] != hdr:
             return self.ERROR_INVALID_HEADER
+        players = [self.player_from_row(player_row) for player_row in self.data_list[1:]]
+        if self.upsert:
+            return self.upsert_players(players)
         Player.delete_all()
         Bid.delete_all()
+        BidEntry.delete_all()
         Player.init_batch()
-        for player_row in self.data_list[1:]:
-            player_row.reverse()
-            player = Player(player_row.pop().strip())
-            player.country = player_row.pop().strip()
-            country = Country(player.country)
-            player.rank = country.rank
-            player.color = country.color
-            player.bg_color = country.bg_color
-            player.country_code = country.code
-            player.type = player_row.pop().strip()
-            tags = [tag.strip().lower() for tag in player_row.pop().split(';') if len(tag) > 0]
-            tags.append(player.country.lower())
-            tags.append(player.country_code.lower())
-            if player.type.lower() not in tags:
-                tags.append(player.type.lower())
-            player.tags = tags
-            try:
-                player.bid_order = int(player_row.pop())
-            except ValueError:
-                pass
-            try:
-                player.matches = int(player_row.pop())
-            except ValueError:
-                pass
-            try:
-                player.runs = int(player_row.pop())
-            except ValueError:
-                pass
-            try:
-                player.catches = int(player_row.pop())
-            except ValueError:
-                pass
-            try:
-                player.balls = int(player_row.pop())
-            except ValueError:
-                pass
-            try:
-                player.wickets = int(player_row.pop())
-            except ValueError:
-                pass
+        for player in players:
             player.update_batch()
         Player.commit_batch()
         Game.init_game()
         return self.SUCCESS
 
+    @staticmethod
+    def player_from_row(player_row):
+        player_row.reverse()
+        player = Player(player_row.pop().strip())
+        player.country = player_row.pop().strip()
+        country = Country(player.country)
+        player.rank = country.rank
+        player.color = country.color
+        player.bg_color = country.bg_color
+        player.country_code = country.code
+        player.type = player_row.pop().strip()
+        tags = [tag.strip().lower() for tag in player_row.pop().split(';') if len(tag) > 0]
+        tags.append(player.country.lower())
+        tags.append(player.country_code.lower())
+        if player.type.lower() not in tags:
+            tags.append(player.type.lower())
+        player.tags = tags
+        try:
+            player.bid_order = int(player_row.pop())
+        except ValueError:
+            pass
+        try:
+            player.matches = int(player_row.pop())
+        except ValueError:
+            pass
+        try:
+            player.runs = int(player_row.pop())
+        except ValueError:
+            pass
+        try:
+            player.catches = int(player_row.pop())
+        except ValueError:
+            pass
+        try:
+            player.balls = int(player_row.pop())
+        except ValueError:
+            pass
+        try:
+            player.wickets = int(player_row.pop())
+        except ValueError:
+            pass
+        return player
+
+    def upsert_players(self, players):
+        # Writes only the players added, changed or removed. The auction fields of the changed players are kept.
+        # Players not in the file are removed only if they are still available for bid.
+        stored_players = Player.get_all(dict_type=True)
+        self.report = {'added': list(), 'changed': list(), 'removed': list(), 'kept': list(), 'unchanged': 0}
+        updates = list()
+        deletes = list()
+        for player in players:
+            stored_player = stored_players.pop(player.doc_id, None)
+            if not stored_player:
+                self.report['added'].append(player.name)
+                updates.append(player)
+                continue
+            changes = {field: getattr(player, field) for field in self.PLAYER_FIELDS
+                       if getattr(player, field) != getattr(stored_player, field)}
+            if not changes:
+                self.report['unchanged'] += 1
+                continue
+            self.report['changed'].append(player.name)
+            for field, value in changes.items():
+                setattr(stored_player, field, value)
+            updates.append(stored_player)
+        for stored_player in stored_players.values():
+            if stored_player.status != Player.AVAILABLE:
+                self.report['kept'].append(stored_player.name)
+                continue
+            self.report['removed'].append(stored_player.name)
+            deletes.append(stored_player)
+        if self.dry_run:
+            return self.SUCCESS
+        Player.init_batch()
+        for player in updates:
+            player.update_batch()
+        for player in deletes:
+            player.delete_batch()
+        Player.commit_batch()
+        game = Game.read()
+        if not game:
+            Game.init_game()
+        elif game.player_to_bid == game.player_count and not game.bid_in_progress:
+            # The counts of an auction that has started are not changed
+            game.set_player_count()
+        else:
+            game.bump_revision()
+        return self.SUCCESS
+
     def upload_scores(self):
         hdr = ['player', 'score']
         if self.data_list[0] != hdr:
             return self.ERROR_INVALID_HEADER
-        errors = list()
-        Player.init_batch()
+        scores = list()
         for player_row in self.data_list[1:]:
-            name = player_row[0]
             try:
-                score = float(player_row[1])
+                scores.append({'player': player_row[0], 'score': round(float(player_row[1]), 1)})
             except ValueError:
                 continue
-            player = Player.query_first(name=name)
-            if not player:
-                errors.append(name)
-                continue
-            player.score = round(score, 1)
-            player.update_batch()
-        Player.commit_batch()
+        players = Player.read_names([score['player'] for score in scores])
+        errors = [score['player'] for score in scores if Player.name_to_id(score['player']) not in players]
+        Player.update_scores(scores, players)
         sync_player_user_points()
+        game = Game.read()
+        if game:
+            game.bump_revision()
         return errors if errors else self.SUCCESS
 
     @classmethod
     def upload_all(cls, file_name='wc.json'):
+        # The file is a snapshot or json based on its extension (refer Download). The documents are written as they are
+        # read so that a large snapshot is not held in memory. Each collection in the file replaces the stored one.
+        download = Download(file_name)
         try:
-            with open(file_name) as json_file:
-                data = json.load(json_file)
+            # The whole file is read once before any collection is replaced so that a bad file changes nothing
+            for _ in download.records():
+                pass
         except FileNotFoundError:
             return cls.ERROR_FILE_NOT_FOUND
-        # Load User data
-        if 'user' in data:
+        except (ValueError, OSError, EOFError):
+            return cls.ERROR_INVALID_HEADER
+        collection = None
+        game = None
+        try:
+            for record_collection, document in download.records():
+                if record_collection != collection:
+                    cls.end_collection(collection)
+                    collection = record_collection
+                    cls.start_collection(collection)
+                if document is None:
+                    continue
+                if collection == 'game':
+                    # There is a single game
+                    if not game:
+                        game = Game.from_dict(document)
+                        if game:
+                            Game.delete_all()
+                            game.create()
+                    continue
+                model = Download.MODELS[collection].from_dict(document) if collection in Download.MODELS else None
+                if not model:
+                    continue
+                # Files downloaded before lots were saved in display form
+                if collection == 'bid' and 'complete' not in document:
+                    model.complete = model.is_bid_complete(game.user_count if game else 0)
+                    model.bid_map.sort(key=lambda item: item['username'])
+                model.update_batch()
+        except FileNotFoundError:
+            return cls.ERROR_FILE_NOT_FOUND
+        except (ValueError, OSError, EOFError):
+            # Only if the file was changed after it was read
+            return cls.ERROR_INVALID_HEADER
+        cls.end_collection(collection)
+        # The players written after the game was created
+        game = Game.read()
+        if game:
+            game.bump_revision()
+        return cls.SUCCESS
+
+    @staticmethod
+    def start_collection(collection):
+        if collection == 'user':
             User.delete_all()
             User.init_batch()
-            for user_dict in data['user']:
-                user = User.from_dict(user_dict)
-                if not user:
-                    continue
-                user.update_batch()
-            User.commit_batch()
-        # Load Game
-        if 'game' in data:
-            game_dict = next((game for game in data['game']), None)
-            if game_dict:
-                game = Game.from_dict(game_dict)
-                if game:
-                    Game.delete_all()
-                    game.create()
-        # Load Player
-        if 'player' in data:
+        elif collection == 'player':
             Player.delete_all()
             Player.init_batch()
-            for player_dict in data['player']:
-                player = Player.from_dict(player_dict)
-                if not player:
-                    continue
-                player.update_batch()
-            Player.commit_batch()
-        # Load Bid
-        if 'bid' in data:
+        elif collection == 'bid':
             Bid.delete_all()
+            BidEntry.delete_all()
             Bid.init_batch()
-            for bid_dict in data['bid']:
-                bid = Bid.from_dict(bid_dict)
-                if not bid:
-                    continue
-                bid.update_batch()
+
+    @staticmethod
+    def end_collection(collection):
+        if collection == 'user':
+            User.commit_batch()
+            User.uncache()
+            Roster.build()
+        elif collection == 'player':
+            Player.commit_batch()
+        elif collection == 'bid':
             Bid.commit_batch()
-        return cls.SUCCESS
 
 
 class Download:
-    def __init__(self, file_name='wc.json'):
+    # Collections in a download and the field that identifies a document in each. There is a single game.
+    KEYS = {
+        'game': None,
+        'user': 'username',
+        'player': 'name',
+        'bid': 'player_name',
+    }
+    MODELS = {
+        'game': Game,
+        'user': User,
+        'player': Player,
+        'bid': Bid,
+    }
+
+    def __init__(self, file_name='wc.json', delta_file='wc-delta.jsonl'):
+        # A file name with the snapshot extension (.snap) is written in the compressed binary format
         self.file_name = file_name
+        # Each line of the delta log has the documents changed after the previous line and the time of the latest
+        # change in them. A full download starts the log again.
+        self.delta_file = delta_file
 
     def __call__(self):
+        # The time is taken before the read so that no change is missed by the next delta
+        hwm = self.last_updated()
         data = dict()
         # Game
         data['game'] = list()
@@ -585,5 +766,103 @@ class Download:
         for bid in bids:
             data['bid'].append(bid.to_dict())
         # Write to the file
+        self.write(data)
+        self.start_log(hwm)
+
+    def write(self, data):
+        if is_snapshot(self.file_name):
+            write_snapshot(self.file_name, data)
+            return
         with open(self.file_name, 'w') as json_file:
             json.dump(data, json_file, ensure_ascii=False, sort_keys=True, indent=4)
+
+    def read(self):
+        if is_snapshot(self.file_name):
+            return load_snapshot(self.file_name)
+        with open(self.file_name) as json_file:
+            return json.load(json_file)
+
+    def records(self):
+        # Yields (collection, document) and (collection, None) at the start of each collection (refer read_snapshot).
+        # A snapshot is read one document at a time. The game is before the other collections in a json file.
+        if is_snapshot(self.file_name):
+            yield from read_snapshot(self.file_name)
+            return
+        data = self.read()
+        for collection in self.KEYS:
+            if collection not in data:
+                continue
+            yield collection, None
+            for document in data[collection]:
+                yield collection, document
+
+    def last_updated(self):
+        times = [model.last_updated() for model in self.MODELS.values()]
+        times = [time for time in times if time]
+        return max(times) if times else None
+
+    def start_log(self, hwm):
+        delta = {collection: list() for collection in self.KEYS}
+        delta['hwm'] = encode_timestamp(hwm)
+        with open(self.delta_file, 'w') as delta_file:
+            delta_file.write(json.dumps(delta) + '\n')
+
+    def read_log(self):
+        # Yields each delta of the log. There is no delta without a log.
+        try:
+            with open(self.delta_file) as delta_file:
+                for line in delta_file:
+                    if line.strip():
+                        yield json.loads(line)
+        except FileNotFoundError:
+            return
+
+    def read_hwm(self):
+        hwm = None
+        for delta in self.read_log():
+            hwm = delta['hwm'] or hwm
+        return decode_timestamp(hwm)
+
+    def changes(self, hwm):
+        # Returns the documents changed after hwm by collection and the time of the latest change in them
+        latest = hwm
+        delta = dict()
+        for collection, model in self.MODELS.items():
+            models, updated = model.updated_since(hwm)
+            if collection == 'game' and models:
+                # Read again for the counters
+                models = [Game.read()]
+            delta[collection] = [model.to_dict() for model in models if model]
+            if updated and (latest is None or updated > latest):
+                latest = updated
+        return delta, latest
+
+    def delta(self):
+        # Appends the documents changed since the last line of the delta log. Returns the number of documents.
+        delta, latest = self.changes(self.read_hwm())
+        changed = sum(len(documents) for documents in delta.values())
+        if changed == 0:
+            return 0
+        delta['hwm'] = encode_timestamp(latest)
+        with open(self.delta_file, 'a') as delta_file:
+            delta_file.write(json.dumps(delta, ensure_ascii=False) + '\n')
+        return changed
+
+    def compact(self):
+        # Folds the delta log into the download in file_name and starts the log again from its last time.
+        # Documents deleted after the download are not removed. Take a full download after an upload.
+        try:
+            data = self.read()
+        except FileNotFoundError:
+            data = dict()
+        records = dict()
+        for collection, key in self.KEYS.items():
+            records[collection] = {record[key] if key else None: record for record in data.get(collection, list())}
+        hwm = None
+        for delta in self.read_log():
+            hwm = delta['hwm'] or hwm
+            for collection, key in self.KEYS.items():
+                for record in delta.get(collection, list()):
+                    records[collection][record[key] if key else None] = record
+        self.write({collection: list(records[collection].values()) for collection in self.KEYS})
+        self.start_log(decode_timestamp(hwm))
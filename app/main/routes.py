@@ -1,17 +1,27 @@
-from flask import render_template, request, url_for, flash, redirect, jsonify, g, current_app
+from flask import render_template, request, url_for, flash, redirect, jsonify, g, current_app, make_response
 from flask_login import login_required, current_user
 from app.main import bp
+from app.fragments import render_fragment
+from app.http_cache import not_modified, cache_headers
+from app.main import game_transactions
 from app.main.forms import BidForm, SearchForm
 from app.main.game_transactions import *
+from firestore_model import gather
 from config import Config
 
 
 @bp.before_request
 def before_request():
-    game = Game.read()
-    if game is None:
-        game = Game.init_game()
-    g.game = game
+    # The views are served from the replica in memory if there is one (refer Config.REPLICA_FILE)
+    replica = current_app.replica
+    g.views = replica or game_transactions
+    if replica:
+        g.game = replica.game or Game()
+    else:
+        game = Game.read_cached()
+        if game is None:
+            game = Game.init_game()
+        g.game = game
     if current_user.is_authenticated:
         g.search_form = SearchForm()
     if current_app and current_app.config.get('TESTING'):
@@ -27,7 +37,7 @@ def before_request():
 def index():
     template = 'index.html'
     title = 'Home'
-    users = ranked_users_view()
+    users = g.views.ranked_users_view()
     return render_template(template, title=title, users=users)
 
 
@@ -36,8 +46,13 @@ def index():
 def purchased_players(username):
     template = 'purchased.html'
     title = 'Players'
-    data = purchased_players_view(username)
-    return render_template(template, title=title, players=data['players'], summary=data['summary'])
+    response = not_modified(g.views.purchased_players_updated(username))
+    if response:
+        return response
+    data = g.views.purchased_players_view(username)
+    player_table = render_fragment('_player_table.html', ('purchased', username), **data)
+    return cache_headers(make_response(render_template(template, title=title, players=data['players'],
+                                                       player_table=player_table)))
 
 
 @bp.route('/available')
@@ -46,27 +61,31 @@ def available_players():
     template = 'available.html'
     title = 'Players'
     direction = request.args.get('direction', FirestorePage.NEXT_PAGE, type=int)
-    start_id = request.args.get('start', '')
-    end_id = request.args.get('end', '')
-    page = available_players_view(Config.PER_PAGE, start=start_id, end=end_id, direction=direction)
+    cursor = request.args.get('cursor', '')
+    page = g.views.available_players_view(Config.PER_PAGE, cursor=cursor, direction=direction)
     if not page:
         return render_template(template, title=title)
     next_url = None
     prev_url = None
     if page.has_next:
-        next_url = url_for('main.available_players', end=page.current_end.doc_id)
+        next_url = url_for('main.available_players', cursor=page.next_cursor)
     if page.has_prev:
-        prev_url = url_for('main.available_players', start=page.current_start.doc_id, direction=FirestorePage.PREV_PAGE)
-    return render_template(template, title=title, players=page.items, next_url=next_url, prev_url=prev_url)
+        prev_url = url_for('main.available_players', cursor=page.prev_cursor, direction=FirestorePage.PREV_PAGE)
+    player_table = render_fragment('_available_table.html', ('available', cursor, direction), players=page.items)
+    return render_template(template, title=title, players=page.items, next_url=next_url, prev_url=prev_url,
+                           player_table=player_table)
 
 
 @bp.route('/players/<player_id>')
 @login_required
 def player_profile(player_id):
     template = 'player.html'
-    player = player_view(player_id)
+    response = not_modified(g.views.player_updated(player_id))
+    if response:
+        return response
+    player = g.views.player_view(player_id)
     title = player.name
-    return render_template(template, title=title, player=player)
+    return cache_headers(make_response(render_template(template, title=title, player=player)))
 
 
 @bp.route('/bid', methods=['GET', 'POST'])
@@ -74,23 +93,37 @@ def player_profile(player_id):
 def bid_player():
     template = 'bid.html'
     title = 'Bid'
+    if current_app.replica:
+        flash("Bids are not accepted on a read only server")
+        return redirect(url_for('main.index'))
     if not g.game.bid_in_progress:
         flash("No bid in progress")
         return redirect(url_for('main.index'))
-    bid = Bid.query_first(player_name=g.game.player_in_bidding)
+    # The bid, the player and the pending users are independent reads. The pending users come from the cached game
+    # and are only shown. An earlier bid is checked on the lot read here and again when the bid is submitted.
+    doc_id = Player.name_to_id(g.game.player_in_bidding)
+    bid, player, users = gather((Bid.read, doc_id), (Player.read, doc_id), (User.read_many, g.game.users_to_bid))
+    if not bid:
+        flash("No bid in progress")
+        return redirect(url_for('main.index'))
     if bid.has_bid(current_user.username):
-        flash(f"You have already bid. Please wait for other {g.game.user_to_bid} users to bid.")
+        flash(f'You have already bid for {bid.player_name}.')
         return redirect(url_for('main.available_players'))
-    player = Player.read(bid.doc_id)
     bid_form = BidForm(current_user.balance)
-    pending = [User.read(username).name for username in g.game.users_to_bid]
+    pending = [user.name for user in users]
     if not bid_form.validate_on_submit():
         if bid_form.amount.errors:
             for error in bid_form.amount.errors:
                 flash(error)
         return render_template(template, title=title, bid=bid, form=bid_form, player=player, pending=pending)
     amount = bid_form.amount.data if bid_form.amount.data else Bid.PASS
-    accept_bid(bid, current_user, amount)
+    if current_app.config.get('BID_INTAKE') == 'entries':
+        result = submit_bid(bid, current_user, amount)
+    else:
+        result = accept_bid(bid, current_user, amount)
+    if result == Bid.ERROR_ALREADY_BID:
+        flash(f'You have already bid for {bid.player_name}.')
+        return redirect(url_for('main.available_players'))
     flash(f'Your bid for {bid.player_name} was submitted.')
     return redirect(url_for('main.available_players'))
 
@@ -101,17 +134,16 @@ def show_bids():
     template = 'bids.html'
     title = 'Bids'
     direction = request.args.get('direction', FirestorePage.NEXT_PAGE, type=int)
-    start_id = request.args.get('start', '')
-    end_id = request.args.get('end', '')
-    page = bids_view(Config.PER_PAGE, start=start_id, end=end_id, direction=direction)
+    cursor = request.args.get('cursor', '')
+    page = g.views.bids_view(Config.PER_PAGE, cursor=cursor, direction=direction)
     if not page:
         return render_template(template, title=title)
     next_url = None
     prev_url = None
     if page.has_next:
-        next_url = url_for('main.show_bids', end=page.current_end.doc_id)
+        next_url = url_for('main.show_bids', cursor=page.next_cursor)
     if page.has_prev:
-        prev_url = url_for('main.show_bids', start=page.current_start.doc_id, direction=FirestorePage.PREV_PAGE)
+        prev_url = url_for('main.show_bids', cursor=page.prev_cursor, direction=FirestorePage.PREV_PAGE)
     return render_template(template, title=title, bids=page.items, next_url=next_url, prev_url=prev_url)
 
 
@@ -130,12 +162,15 @@ def player_search():
     if not g.search_form.validate():
         return redirect(url_for('main.home'))
     tags = g.search_form.q.data.lower().split(';')
-    data = search_players_view(tags)
+    data = g.views.search_players_view(tags)
     if not data:
         data = {'players': None, 'summary': None}
+    player_table = None
+    if data['players']:
+        player_table = render_fragment('_player_table.html', ('search',) + tuple(tags), **data)
     tags_help = dict()
     tags_help['countries'] = Country.CODES
     tags_help['types'] = ['opener', 'middle order', 'wicket keeper', 'allrounder', 'fast bowler', 'spin bowler']
     tags_help['others'] = ['backup', 'injury', 'captain']
-    return render_template(template, title=title, players=data['players'],
-                           tags=tags, summary=data['summary'], help=tags_help)
+    return render_template(template, title=title, players=data['players'], player_table=player_table,
+                           tags=tags, help=tags_help)
@@ -0,0 +1,204 @@
+from threading import Lock, Thread, Event
+from firestore_model import FirestorePage, decode_timestamp
+from app.models import Player, Game
+from app.main.game_transactions import Download, player_summary
+
+
+class Replica:
+    # Read only copy of a download in memory with the indexes required by the views (refer Config.REPLICA_FILE).
+    # It has the same views as game_transactions. Changes in firestore are applied as deltas (refer refresh).
+
+    def __init__(self, file_name, delta_file=None):
+        self.download = Download(file_name, delta_file) if delta_file else Download(file_name)
+        self.lock = Lock()
+        self.stop = Event()
+        # Time of the latest change applied
+        self.hwm = None
+        self.game = None
+        self.users = dict()
+        self.players = dict()
+        self.bids = dict()
+        # Indexes
+        self.ranked_users = list()
+        self.owned_players = dict()
+        self.tagged_players = dict()
+        self.available_players = list()
+        self.complete_bids = list()
+
+    def load(self):
+        # The download and then the deltas logged after it
+        self.apply(self.download.read())
+        for delta in self.download.read_log():
+            self.apply(delta)
+            self.hwm = decode_timestamp(delta['hwm']) or self.hwm
+        return self
+
+    def refresh(self):
+        # Applies the documents changed in firestore after the latest change applied. Returns the number applied.
+        delta, latest = self.download.changes(self.hwm)
+        changed = sum(len(documents) for documents in delta.values())
+        if changed:
+            self.apply(delta)
+        self.hwm = latest
+        return changed
+
+    def watch(self, interval):
+        # Refresh every interval seconds on a background thread
+        if not interval:
+            return None
+        thread = Thread(target=self.refresh_loop, args=(interval,), daemon=True)
+        thread.start()
+        return thread
+
+    def refresh_loop(self, interval):
+        while not self.stop.wait(interval):
+            self.refresh()
+
+    def apply(self, data):
+        # data has the documents of each collection as in a download. The indexes are built again.
+        with self.lock:
+            games = data.get('game', list())
+            game = Game.from_dict(games[-1]) if games else self.game
+            users = dict(self.users)
+            players = dict(self.players)
+            bids = dict(self.bids)
+            for models, collection in ((users, 'user'), (players, 'player'), (bids, 'bid')):
+                for document in data.get(collection, list()):
+                    model = self.download.MODELS[collection].from_dict(document)
+                    if model:
+                        models[model.doc_id] = model
+            self.index(game, users, players, bids)
+
+    def index(self, game, users, players, bids):
+        # Ties are in the order of the doc_id in the direction of the last field as in a firestore query
+        ranked_users = sorted(users.values(), key=lambda user: (user.points, user.balance, user.doc_id), reverse=True)
+        owned_players = dict()
+        tagged_players = dict()
+        for player in players.values():
+            if player.owner_username:
+                owned_players.setdefault(player.owner_username, list()).append(player)
+            for tag in player.tags:
+                tagged_players.setdefault(tag, set()).add(player.doc_id)
+        for owned in owned_players.values():
+            owned.sort(key=lambda player: (player.score, player.price, player.doc_id), reverse=True)
+        available_players = sorted((player for player in players.values() if player.status == Player.AVAILABLE),
+                                   key=lambda player: (player.bid_order, player.doc_id))
+        complete_bids = sorted((bid for bid in bids.values() if bid.complete),
+                               key=lambda bid: (bid.bid_order or 0, bid.doc_id), reverse=True)
+        # Replaced together so that a view always sees one version
+        self.game, self.users, self.players, self.bids = game, users, players, bids
+        self.ranked_users, self.owned_players, self.tagged_players = ranked_users, owned_players, tagged_players
+        self.available_players, self.complete_bids = available_players, complete_bids
+
+    def user(self, username):
+        return self.users.get(username)
+
+    @staticmethod
+    def page(items, field, per_page, cursor, direction, descending=False):
+        # Pagination as in FirestoreModel.order_by of items already in the order of the field and the doc_id
+        page = FirestorePage(per_page, cursor)
+        page.field = field
+        page.want = direction
+        cursor = page.decode_cursor(cursor)
+        if page.want == FirestorePage.PREV_PAGE and not cursor:
+            page.items = list()
+            return page
+        position = 0
+        if cursor:
+            cursor = (cursor[0] or 0, cursor[1])
+
+            # The first item after the cursor. The item of the cursor may no longer be in the list.
+            def after(item):
+                key = (getattr(item, field) or 0, item.doc_id)
+                return key < cursor if descending else key > cursor
+            try:
+                position = next((index for index, item in enumerate(items) if after(item)), len(items))
+            except TypeError:
+                # The value of the cursor is not of the type of the field. It has been tampered.
+                page.items = list()
+                return page
+        if page.want == FirestorePage.PREV_PAGE:
+            end = position
+            if end > 0 and (getattr(items[end - 1], field) or 0, items[end - 1].doc_id) == cursor:
+                end -= 1
+            start = max(0, end - per_page)
+            page.items = items[start:end]
+            page.has_prev = start > 0
+            page.has_next = end < len(items)
+        else:
+            page.items = items[position:position + per_page]
+            page.has_next = position + per_page < len(items)
+            page.has_prev = position > 0
+        page.current_start = page.items[0] if page.items else None
+        page.current_end = page.items[-1] if page.items else None
+        return page
+
+    def ranked_users_view(self):
+        return list(self.ranked_users)
+
+    def player_view(self, player_id):
+        return self.players.get(player_id)
+
+    def player_updated(self, player_id):
+        # The time of the latest change applied to the replica (refer game_transactions.player_updated)
+        return self.hwm
+
+    def available_players_view(self, per_page=None, cursor='', direction=FirestorePage.NEXT_PAGE):
+        if per_page is None or direction not in [FirestorePage.NEXT_PAGE, FirestorePage.PREV_PAGE]:
+            return list(self.available_players)
+        page = self.page(self.available_players, 'bid_order', per_page, cursor, direction)
+        if len(page.items) == 0:
+            return None
+        return page
+
+    def purchased_players_view(self, username):
+        data = dict()
+        data['players'] = list(self.owned_players.get(username, list()))
+        data['summary'] = player_summary(data['players'])
+        return data
+
+    def purchased_players_updated(self, username):
+        return self.hwm
+
+    def search_players_view(self, tags):
+        # Same results as game_transactions.search_players_view
+        if isinstance(tags, str):
+            tags = [tags.strip()]
+        if not isinstance(tags, list) and not isinstance(tags, tuple):
+            return None
+        if len(tags) < 1 or len(tags) > 10:
+            return None
+        players = self.players
+        doc_ids = set()
+        for tag in tags:
+            tag = tag.strip()
+            if not tag:
+                continue
+            not_query = False
+            if tag[0] == '-':
+                not_query = True
+                tag = tag[1:]
+            with_tag = self.tagged_players.get(tag)
+            if not with_tag:
+                continue
+            if not not_query:
+                doc_ids = with_tag if not doc_ids else doc_ids & with_tag
+                continue
+            without_tag = (doc_ids or set(players)) - with_tag
+            if without_tag:
+                doc_ids = without_tag
+        if not doc_ids:
+            return None
+        data = dict()
+        data['players'] = sorted((players[doc_id] for doc_id in sorted(doc_ids)),
+                                 key=lambda player: (player.score, player.price), reverse=True)
+        data['summary'] = player_summary(data['players'])
+        return data
+
+    def bids_view(self, per_page=None, cursor='', direction=FirestorePage.NEXT_PAGE):
+        if per_page is None or direction not in [FirestorePage.NEXT_PAGE, FirestorePage.PREV_PAGE]:
+            return list(self.complete_bids)
+        page = self.page(self.complete_bids, 'bid_order', per_page, cursor, direction, descending=True)
+        if len(page.items) == 0:
+            return None
+        return page
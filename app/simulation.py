@@ -0,0 +1,182 @@
+import math
+import random
+from collections import Counter
+from threading import Thread, Lock
+from time import perf_counter, sleep
+from firestore_model import transaction_counts, reset_transaction_counts
+from app.models import User, Player, Game, Bid, BidEntry, Country
+from app.main.game_transactions import invite_bid, accept_bid, submit_bid, aggregate_bids
+
+
+class Simulation:
+    # Stats per match by player type - runs, wickets, balls, catches
+    PROFILES = {
+        'opener': (38, 0, 0, 0.4),
+        'middle order': (32, 0.1, 6, 0.5),
+        'wicket keeper': (26, 0, 0, 1.2),
+        'allrounder': (22, 0.9, 36, 0.4),
+        'fast bowler': (6, 1.6, 54, 0.3),
+        'spin bowler': (8, 1.3, 54, 0.3),
+    }
+    # Seconds to wait before a bidder checks the game again
+    POLL = 0.2
+    # Seconds without a bid after which the simulation is stopped
+    TIMEOUT = 30
+    # Chance of a bidder passing the player
+    PASS_RATE = 0.1
+
+    INTAKES = ('transaction', 'entries')
+
+    def __init__(self, users=10, players=150, bidders=None, seed=None, intake='transaction'):
+        self.user_count = users
+        self.player_count = players
+        self.bidders = max(1, min(bidders or users, users))
+        # Refer Config.BID_INTAKE
+        self.intake = intake if intake in self.INTAKES else self.INTAKES[0]
+        self.random = random.Random(seed)
+        self.latencies = list()
+        self.results = Counter()
+        self.lock = Lock()
+        self.last_bid_time = 0.0
+        self.stats = dict()
+
+    def generate_users(self):
+        users = list()
+        for index in range(1, self.user_count + 1):
+            user = User(username=f'u{index:03}', name=f'User {index}')
+            user.color = 'white'
+            user.bg_color = self.random.choice([country['bg_color'] for country in Country.DATA.values()])
+            users.append(user)
+        return users
+
+    def generate_players(self):
+        players = list()
+        for index in range(1, self.player_count + 1):
+            player = Player(f'Player {index:04}')
+            country = Country(self.random.choice(Country.CODES))
+            player.country = country.name
+            player.country_code = country.code
+            player.rank = country.rank
+            player.color = country.color
+            player.bg_color = country.bg_color
+            player.type = self.random.choice(list(self.PROFILES))
+            runs, wickets, balls, catches = self.PROFILES[player.type]
+            player.matches = self.random.randint(1, 200)
+            player.runs = self.stat(runs, player.matches)
+            player.wickets = self.stat(wickets, player.matches)
+            player.balls = self.stat(balls, player.matches)
+            player.catches = self.stat(catches, player.matches)
+            player.tags = [player.country.lower(), player.country_code, player.type]
+            if self.random.random() < 0.2:
+                player.tags.append('backup')
+            player.bid_order = index
+            players.append(player)
+        return players
+
+    def stat(self, per_match, matches):
+        if per_match <= 0:
+            return 0
+        return max(0, round(self.random.gauss(per_match, per_match / 3) * matches))
+
+    def generate(self):
+        # Replaces ALL the data in the database with a synthetic league
+        for model in (BidEntry, Bid, Player, User, Game):
+            model.delete_all()
+        User.init_batch()
+        for user in self.generate_users():
+            user.update_batch()
+        User.commit_batch()
+        User.uncache()
+        Player.init_batch()
+        for player in self.generate_players():
+            player.update_batch()
+        Player.commit_batch()
+        return Game.init_game()
+
+    def amount(self, game, user):
+        if self.random.random() < self.PASS_RATE:
+            return Bid.PASS
+        suggested = game.avg_player_bid
+        amount = self.random.randint(max(suggested - 20, 1), max(suggested + 20, 1))
+        return min(amount, user.balance)
+
+    def bidder(self, users):
+        # With entries intake the game is updated later by the aggregator. The lots bid are remembered to bid once.
+        submitted = set()
+        while perf_counter() - self.last_bid_time < self.TIMEOUT:
+            game = Game.read()
+            if not game or game.player_to_bid == 0:
+                return
+            pending = [user for user in users if game.bid_in_progress and user.username in game.users_to_bid
+                       and (game.player_in_bidding, user.username) not in submitted]
+            if not pending:
+                sleep(self.POLL)
+                continue
+            bid = Bid.read(Player.name_to_id(game.player_in_bidding))
+            for user in pending:
+                user.refresh()
+                amount = self.amount(game, user)
+                start = perf_counter()
+                if self.intake == 'entries':
+                    result = submit_bid(bid, user, amount)
+                    submitted.add((game.player_in_bidding, user.username))
+                else:
+                    result = accept_bid(bid, user, amount)
+                end = perf_counter()
+                with self.lock:
+                    self.latencies.append(end - start)
+                    self.results['lot closed' if isinstance(result, Bid) else result] += 1
+                    self.last_bid_time = end
+
+    def aggregator(self):
+        while perf_counter() - self.last_bid_time < self.TIMEOUT:
+            result = aggregate_bids()
+            if result == Bid.ERROR_NO_MORE_PLAYERS:
+                return
+            if isinstance(result, Bid):
+                with self.lock:
+                    self.results['lot closed'] += 1
+                continue
+            sleep(self.POLL / 4)
+
+    @staticmethod
+    def percentile(values, percent):
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+    def run(self):
+        # Runs the complete auction with concurrent bidders. Call generate before this.
+        reset_transaction_counts()
+        users = User.get_all()
+        groups = [users[index::self.bidders] for index in range(self.bidders)]
+        start = perf_counter()
+        self.last_bid_time = start
+        invite_bid()
+        threads = [Thread(target=self.bidder, args=(group,)) for group in groups]
+        if self.intake == 'entries':
+            threads.append(Thread(target=self.aggregator))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - start
+        game = Game.read()
+        lots = self.player_count - (game.player_to_bid if game else self.player_count)
+        self.stats = {
+            'users': self.user_count,
+            'players': self.player_count,
+            'bidders': self.bidders,
+            'intake': self.intake,
+            'lots': lots,
+            'bids': len(self.latencies),
+            'seconds': round(elapsed, 2),
+            'lots_per_second': round(lots / elapsed, 2) if elapsed > 0 else 0.0,
+            'p50': round(self.percentile(self.latencies, 50) * 1000, 1),
+            'p95': round(self.percentile(self.latencies, 95) * 1000, 1),
+            'p99': round(self.percentile(self.latencies, 99) * 1000, 1),
+            'results': dict(self.results),
+            'transactions': transaction_counts(),
+        }
+        return self.stats
@@ -0,0 +1,179 @@
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+from app import create_app
+from app.main.game_transactions import *
+from app.models import User, Player, Game, Bid
+from app.simulation import Simulation
+from firestore_model import firestore_stats, reset_firestore_stats
+from snapshot import EXTENSION
+from config import TestConfig
+
+# League size - users, players
+LEAGUES = {
+    'small': (4, 50),
+    'medium': (10, 150),
+    'large': (20, 500),
+}
+SEED = 2019
+BASELINE_FILE = 'benchmark-baseline.json'
+# A run slower than the baseline by more than this fraction is reported as a regression
+TOLERANCE = 0.25
+# Modules imported on a cold start - the score update cloud function and the models of the web app
+IMPORTS = ('main', 'app.models')
+
+
+class Benchmark:
+    def __init__(self, users, players):
+        self.simulation = Simulation(users, players, seed=SEED)
+        self.results = dict()
+
+    def measure(self, name, function, *args, repeat=1):
+        # Records the average wall time (ms) and firestore round trips of one call
+        reset_firestore_stats()
+        start = perf_counter()
+        result = None
+        for _ in range(repeat):
+            result = function(*args)
+        elapsed = perf_counter() - start
+        round_trips = firestore_stats()['calls']
+        self.results[name] = {
+            'time': round(elapsed * 1000 / repeat, 1),
+            'round_trips': round(round_trips / repeat, 1),
+        }
+        return result
+
+    def write_players_csv(self, file_name):
+        players = self.simulation.generate_players()
+        with open(file_name, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['name', 'country', 'type', 'tags', 'bid_order', 'matches', 'runs', 'catches', 'balls',
+                             'wickets'])
+            for player in players:
+                tags = [tag for tag in player.tags if tag not in (player.country.lower(), player.country_code,
+                                                                  player.type)]
+                writer.writerow([player.name, player.country, player.type, ';'.join(tags), player.bid_order,
+                                 player.matches, player.runs, player.catches, player.balls, player.wickets])
+
+    @staticmethod
+    def all_pages():
+        page = available_players_view(TestConfig.PER_PAGE)
+        while page and page.has_next:
+            page = available_players_view(page.per_page, cursor=page.next_cursor)
+
+    @staticmethod
+    def bid_lot(bid, users):
+        # Distinct amounts so that there is no random tie break
+        result = None
+        for index, user in enumerate(users):
+            user.refresh()
+            result = accept_bid(bid, user, min(100 + index, user.balance) or Bid.PASS)
+        return result
+
+    def run(self):
+        self.simulation.generate()
+        upload_data = Upload()
+        upload_data.file_name = os.path.join(tempfile.mkdtemp(), 'players.csv')
+        self.write_players_csv(upload_data.file_name)
+        self.measure('upload_players', upload_data, 'players')
+        self.measure('order_by_pages', self.all_pages)
+        self.measure('search_players_view', search_players_view, ['ind', '-backup'], repeat=3)
+        users = User.get_all()
+        bid = self.measure('invite_bid', invite_bid)
+        self.measure('accept_bid', accept_bid, bid, users[0], 100)
+        bid = self.measure('lot', self.bid_lot, bid, users[1:])
+        for _ in range(3):
+            bid = self.bid_lot(bid, users)
+        self.measure('sync_player_user_points', sync_player_user_points)
+        self.download_formats()
+        return self.results
+
+    def download_formats(self):
+        # Round trip of the downloaded data through each file format. The size of the file is saved as bytes.
+        folder = tempfile.mkdtemp()
+        data = None
+        for file_format, file_name in (('json', 'wc.json'), ('snapshot', 'wc' + EXTENSION)):
+            download_data = Download(os.path.join(folder, file_name), os.path.join(folder, 'wc-delta.jsonl'))
+            if data is None:
+                download_data()
+                data = download_data.read()
+            self.measure(f'write_{file_format}', download_data.write, data, repeat=3)
+            self.results[f'write_{file_format}']['bytes'] = os.path.getsize(download_data.file_name)
+            self.measure(f'read_{file_format}', download_data.read, repeat=3)
+
+
+def import_time(module, repeat=3):
+    # Best time (ms) to import the module in a fresh interpreter
+    code = f'from time import perf_counter; start = perf_counter(); import {module}; print(perf_counter() - start)'
+    times = list()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        times.append(float(output.split()[-1]))
+    return {'time': round(min(times) * 1000, 1), 'round_trips': 0}
+
+
+def compare(results, baseline):
+    # Returns the list of regressions and prints the results against the baseline
+    regressions = list()
+    for league, operations in results.items():
+        print(f'\n{league}')
+        print(f"{'operation':<26}{'time ms':>10}{'base':>10}{'round trips':>14}{'base':>8}")
+        for name, result in operations.items():
+            base = baseline.get(league, dict()).get(name)
+            flag = ''
+            if base:
+                if result['round_trips'] > base['round_trips'] or result['time'] > base['time'] * (1 + TOLERANCE):
+                    flag = '  REGRESSION'
+                    regressions.append(f'{league}.{name}')
+            base_time = base['time'] if base else '-'
+            base_round_trips = base['round_trips'] if base else '-'
+            print(f"{name:<26}{result['time']:>10}{base_time:>10}{result['round_trips']:>14}{base_round_trips:>8}"
+                  f"{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the game engine on synthetic leagues. '
+                                                 'ALL data in the test database is replaced.')
+    parser.add_argument('leagues', nargs='*', help=f"League sizes to run from {', '.join(LEAGUES)}. Default is all.")
+    parser.add_argument('--save', action='store_true', help=f'Save the results as the baseline in {BASELINE_FILE}')
+    args = parser.parse_args()
+    leagues = args.leagues or list(LEAGUES)
+    if any(league not in LEAGUES for league in leagues):
+        parser.error(f"Valid leagues are {', '.join(LEAGUES)}")
+
+    app = create_app(TestConfig)
+    app_context = app.app_context()
+    app_context.push()
+    results = {'imports': {f'import {module}': import_time(module) for module in IMPORTS}}
+    for league in leagues:
+        results[league] = Benchmark(*LEAGUES[league]).run()
+    app_context.pop()
+
+    try:
+        with open(BASELINE_FILE) as baseline_file:
+            baseline = json.load(baseline_file)
+    except FileNotFoundError:
+        print(f'No baseline in {BASELINE_FILE}. Create it with --save.')
+        baseline = dict()
+    regressions = compare(results, baseline)
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE_FILE, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, sort_keys=True, indent=4)
+        print(f'\nBaseline saved in {BASELINE_FILE}')
+        return 0
+    if regressions:
+        print(f"\nRegressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,10 +16,36 @@ class Config:
     PER_PAGE = 20
     TESTING = False
     USER_FILE_NAME = 'users.csv'
+    # Keep the game in memory with a firestore listener instead of reading it on every request
+    GAME_WATCH = True
+    # Log a json line with the firestore calls of each request and send them in the X-Firestore-Stats header
+    REQUEST_LOG = False
+    # /metrics is served to a scraper with the header Authorization: Bearer <METRICS_TOKEN> or from these addresses
+    METRICS_TOKEN = os.getenv('WC_METRICS_TOKEN')
+    METRICS_ALLOWED_IPS = ('127.0.0.1',)
+    # transaction - each bid updates the lot and the game in a transaction.
+    # entries - each bid is a document of its own and the lots are closed by the aggregator (flask wc aggregate).
+    BID_INTAKE = 'transaction'
+    # Serve the pages read only from a download (flask wc download) kept in memory instead of firestore.
+    # The deltas in REPLICA_DELTA_FILE are applied on load and changes are read again every REPLICA_REFRESH seconds.
+    REPLICA_FILE = os.getenv('WC_REPLICA_FILE')
+    REPLICA_DELTA_FILE = 'wc-delta.jsonl'
+    REPLICA_REFRESH = 60
+    # Size of the rendered player tables kept in memory (refer app.fragments)
+    FRAGMENT_CACHE_BYTES = 4 * 1024 * 1024
+    # Seconds the browser can show the player and squad pages without a check once the auction is over
+    HTTP_CACHE_MAX_AGE = 300
+    # Responses smaller than this are sent uncompressed. brotli is used if installed and accepted, otherwise gzip.
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_LEVEL = 6
+    COMPRESS_CACHE_BYTES = 8 * 1024 * 1024
 
 
 class TestConfig(Config):
     TESTING = True
+    REQUEST_LOG = True
+    # The tests change the game directly and expect the next request to see it
+    GAME_WATCH = False
     GAC_KEY_PATH = 'test-key.json'
     USER_FILE_NAME = 'test-users.csv'
 
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+from io import BytesIO
+from threading import Lock
+
+STATIC_FOLDER = os.path.join('app', 'static')
+# Thumbnails are saved in this folder of static with the hash of their content in the file name. They never change
+# and can be cached by the browser forever. The manifest has the file name of each size by player doc_id.
+# It is outside static so that it is deployed with the code.
+IMAGES_FOLDER = 'images'
+MANIFEST = os.path.join('app', 'image-manifest.json')
+# Maximum width, height in pixels of each size. The profile page shows the image in 256 pixels.
+SIZES = {
+    'profile': (256, 256),
+}
+EXTENSIONS = ('.jpg', '.png', '.gif')
+
+
+class Thumbnails:
+    SUCCESS = 0
+    ERROR_NO_PILLOW = -1
+    ERROR_FOLDER_NOT_FOUND = -2
+    QUALITY = 85
+    # The static folder and the manifest read by the pages
+    STATIC_FOLDER = STATIC_FOLDER
+    MANIFEST_FILE = MANIFEST
+    _manifest = None
+    _manifest_time = None
+    _manifest_lock = Lock()
+
+    def __init__(self, static_folder=None, manifest_file=None):
+        self.static_folder = static_folder or self.STATIC_FOLDER
+        self.images_folder = os.path.join(self.static_folder, IMAGES_FOLDER)
+        self.manifest_file = manifest_file or self.MANIFEST_FILE
+        self.report = dict()
+
+    def originals(self):
+        # The image of each player is saved in static as <doc_id>.jpg, .png or .gif
+        originals = dict()
+        for file_name in sorted(os.listdir(self.static_folder)):
+            doc_id, extension = os.path.splitext(file_name)
+            if extension.lower() in EXTENSIONS and doc_id not in originals:
+                originals[doc_id] = os.path.join(self.static_folder, file_name)
+        return originals
+
+    def __call__(self):
+        # Builds the thumbnails of all the images and the manifest. Old thumbnails are removed.
+        # Pillow is only required to build them. It is not imported by the pages or the cloud function.
+        try:
+            from PIL import Image
+        except ImportError:
+            return self.ERROR_NO_PILLOW
+        if not os.path.isdir(self.static_folder):
+            return self.ERROR_FOLDER_NOT_FOUND
+        os.makedirs(self.images_folder, exist_ok=True)
+        manifest = dict()
+        original_bytes = thumbnail_bytes = 0
+        for doc_id, original in self.originals().items():
+            original_bytes += os.path.getsize(original)
+            manifest[doc_id] = dict()
+            with Image.open(original) as image:
+                image = image.convert('RGB')
+                for size, dimensions in SIZES.items():
+                    thumbnail = image.copy()
+                    thumbnail.thumbnail(dimensions, Image.LANCZOS)
+                    output = BytesIO()
+                    thumbnail.save(output, 'JPEG', quality=self.QUALITY, optimize=True, progressive=True)
+                    data = output.getvalue()
+                    file_name = f'{doc_id}.{size}.{hashlib.sha1(data).hexdigest()[:10]}.jpg'
+                    file_path = os.path.join(self.images_folder, file_name)
+                    if not os.path.exists(file_path):
+                        with open(file_path, 'wb') as image_file:
+                            image_file.write(data)
+                    manifest[doc_id][size] = f'{IMAGES_FOLDER}/{file_name}'
+                    thumbnail_bytes += len(data)
+        file_names = {file_name.split('/')[-1] for files in manifest.values() for file_name in files.values()}
+        removed = 0
+        for file_name in os.listdir(self.images_folder):
+            if file_name.endswith('.jpg') and file_name not in file_names:
+                os.remove(os.path.join(self.images_folder, file_name))
+                removed += 1
+        with open(self.manifest_file, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, sort_keys=True, indent=4)
+        self.report = {
+            'images': len(manifest),
+            'original_bytes': original_bytes,
+            'thumbnail_bytes': thumbnail_bytes,
+            'removed': removed,
+        }
+        return self.SUCCESS
+
+    @classmethod
+    def manifest(cls):
+        # Read again only if the manifest has been built again
+        try:
+            modified = os.path.getmtime(cls.MANIFEST_FILE)
+        except OSError:
+            return dict()
+        with cls._manifest_lock:
+            if modified != cls._manifest_time:
+                with open(cls.MANIFEST_FILE) as manifest_file:
+                    cls._manifest = json.load(manifest_file)
+                cls._manifest_time = modified
+            return cls._manifest
+
+    @classmethod
+    def file_name(cls, doc_id, size):
+        return cls.manifest().get(doc_id, dict()).get(size)
+
+    @classmethod
+    def original(cls, doc_id):
+        # File name in static of the image of the player
+        for extension in EXTENSIONS:
+            if os.path.exists(os.path.join(cls.STATIC_FOLDER, doc_id + extension)):
+                return doc_id + extension
+        return None
@@ -0,0 +1,594 @@
+from copy import copy, deepcopy
+from threading import Lock
+from time import monotonic
+from uuid import uuid4
+from cachetools import TTLCache
+from firestore_model import FirestoreModel, ShardedCounter, track, stamp
+from core.images import Thumbnails
+from metrics import cache_requests
+from config import Config
+
+
+class User(FirestoreModel):
+    INITIAL_BUDGET = Config.INITIAL_BUDGET
+    COLLECTION = 'users'
+    DEFAULT = 'username'
+    # Per process cache of users loaded on every authenticated request
+    CACHE_SIZE = 128
+    CACHE_TTL = 10
+    _cache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+    _cache_lock = Lock()
+
+    def __init__(self, username=None, name=None):
+        super().__init__()
+        self.username = username if username else '**'
+        self.doc_id = username
+        self.name = name if name else 'No Name'
+        self.balance = self.INITIAL_BUDGET
+        self.points = 0.0
+        self.color = 'black'
+        self.bg_color = 'white'
+        self.player_count = 0
+        self.password_hash = None
+
+    def create(self):
+        return self.update()
+
+    def set_password(self, password):
+        self.password_hash = self.hash_password(password)
+
+    @staticmethod
+    def hash_password(password):
+        # Deliberately slow. Use a process pool to hash passwords in bulk (refer Upload.upload_users).
+        from werkzeug.security import generate_password_hash
+        return generate_password_hash(password)
+
+    def check_password(self, password):
+        from werkzeug.security import check_password_hash
+        return check_password_hash(self.password_hash, password)
+
+    def get_id(self):
+        return self.username
+
+    def update(self, doc_id=None):
+        self.uncache(doc_id or self.doc_id)
+        return super().update(doc_id)
+
+    @classmethod
+    def read_cached(cls, username):
+        with cls._cache_lock:
+            user = cls._cache.get(username)
+        cache_requests.inc(cache='user', result='miss' if user is None else 'hit')
+        if user is None:
+            user = cls.read(username)
+            if not user:
+                return None
+            with cls._cache_lock:
+                cls._cache[username] = user
+        # A copy so that changes made while serving one request are not seen by the others
+        return copy(user)
+
+    @classmethod
+    def uncache(cls, username=None):
+        # Call this whenever the balance or points of a user is changed. Without a username the cache is cleared.
+        with cls._cache_lock:
+            if username is None:
+                cls._cache.clear()
+            else:
+                cls._cache.pop(username, None)
+
+
+class Player(FirestoreModel):
+    COLLECTION = 'players'
+    DEFAULT = 'name'
+    # Player status
+    AVAILABLE = 'available'
+    BIDDING = 'bidding'
+    PURCHASED = 'purchased'
+    UNSOLD = 'unsold'
+    # Tags - Accept a not query for
+    TAGS_NOT = ['backup', 'injury', 'captain']
+
+    def __init__(self, name=None):
+        super().__init__(name)
+        self.name = name if name else 'No Name'
+        self.doc_id = self.name_to_id(self.name)
+        self.owner = None
+        self.owner_username = None
+        self.price = 0
+        self.status = self.AVAILABLE
+        self.score = 0
+        self.bid_order = 0
+        self.type = None
+        self.tags = list()
+        self.matches = 0
+        self.runs = 0
+        self.wickets = 0
+        self.balls = 0
+        self.catches = 0
+        # Country related fields
+        self.country = None
+        self.country_code = None
+        self.bg_color = 'white'
+        self.color = 'black'
+        self.rank = 0
+
+    def create(self):
+        return self.update()
+
+    @staticmethod
+    def name_to_id(name):
+        # Players and their bids are saved with the doc_id derived from the player name
+        return name.replace(' ', '_').lower()
+
+    @classmethod
+    def read_names(cls, names):
+        # Returns the players of the names by doc_id. They are read in a single call with the derived doc_ids.
+        doc_ids = list(dict.fromkeys(cls.name_to_id(name) for name in names))
+        return {player.doc_id: player for player in cls.read_many(doc_ids)}
+
+    @classmethod
+    def update_scores(cls, scores, players=None):
+        # Only the scores that have changed are written. Pass the players if already read with read_names.
+        if not scores or 'player' not in scores[0] or 'score' not in scores[0]:
+            return False
+        if players is None:
+            players = cls.read_names([score['player'] for score in scores])
+        Player.init_batch()
+        for score in scores:
+            player = players.get(cls.name_to_id(score['player']))
+            if player and player.score != score['score']:
+                player.score = score['score']
+                player.update_batch()
+        Player.commit_batch()
+        return True
+
+    @property
+    def overs_per_match(self):
+        if self.balls == 0 or self.matches == 0:
+            return 0
+        return self.balls_to_overs(self.balls, self.matches)
+
+    @staticmethod
+    def balls_to_overs(balls, matches):
+        balls_per_match = round(balls / matches)
+        overs = balls_per_match // 6
+        balls = balls_per_match % 6
+        return round(overs + (balls * 0.1), 1)
+
+    @property
+    def runs_per_match(self):
+        if self.matches == 0:
+            return 0
+        return round(self.runs / self.matches, 1)
+
+    @property
+    def wickets_per_match(self):
+        if self.matches == 0:
+            return 0
+        return round(self.wickets / self.matches, 1)
+
+    @property
+    def catches_per_match(self):
+        if self.matches == 0:
+            return 0
+        return round(self.catches / self.matches, 1)
+
+    @property
+    def image_file(self):
+        if not self.doc_id:
+            return None
+        # The resized image if the thumbnails have been built (flask wc thumbnails)
+        return Thumbnails.file_name(self.doc_id, 'profile') or Thumbnails.original(self.doc_id)
+
+    @property
+    def matches_to_play(self):
+        if self.rank <= 0:
+            return 0
+        matches = 9
+        if self.rank <= 4:
+            matches += 1
+            if self.rank <= 2:
+                matches += 1
+        return matches
+
+    @property
+    def playing_xi(self):
+        probability = 0.8
+        if 'captain' in self.tags:
+            probability = 1
+        elif 'backup' in self.tags:
+            probability = 0.5
+        return probability
+
+    @property
+    def value(self):
+        if self.matches == 0:
+            return 10
+        points_per_match = self.runs_per_match * 0.5 + self.wickets_per_match * 12 + self.catches_per_match * 4
+        points = points_per_match * self.matches_to_play
+        # Adjust based on probability in playing XI
+        points *= self.playing_xi
+        # Adjust based on curve of number of matches played (1 match 60%, 50 matches 90%, >=100 matches 100%)
+        adjustment_factor = 1 - 0.00004 * (100 - min(self.matches, 100)) ** 2
+        points *= adjustment_factor
+        return round(points)
+
+    @property
+    def avg_score(self):
+        if self.price <= 0 or self.score <= 0:
+            return 0.0
+        return round(self.price / self.score, 1)
+
+    @property
+    def avg_value(self):
+        if self.price <= 0 or self.value <= 0:
+            return 0.0
+        return round(self.price / self.value, 1)
+
+
+class Game(FirestoreModel):
+    COLLECTION = 'games'
+    DEFAULT = 'user_count'
+    SINGLE_ID = '1'
+    # Process wide snapshot of the game for request handlers (refer read_cached).
+    # It is kept fresh by a listener on the game document. Without a listener it is re-read after CACHE_TTL.
+    CACHE_TTL = 2
+    WATCH_TTL = 60
+    _snapshot = None
+    _snapshot_time = 0.0
+    _snapshot_lock = Lock()
+    _watch = None
+    # These are updated by every bid and purchase. They are saved in sharded counters. The values in the game
+    # document are as of its last update and are replaced by the sum of the shards on every read.
+    COUNTERS = ('user_to_bid', 'total_balance', 'player_to_bid', 'remaining_value')
+    counters = {name: ShardedCounter(name) for name in COUNTERS}
+
+    def __init__(self, default=0):
+        super().__init__(default)
+        self.doc_id = self.SINGLE_ID
+        # Initial after user upload
+        self.user_count = 0
+        self.total_balance = 0
+        # Initialize after player upload
+        self.player_count = 0
+        self.player_to_bid = 0
+        self.remaining_value = 0
+        # Game status
+        self.bid_in_progress = False
+        self.player_in_bidding = None
+        self.user_to_bid = 0        # Initialize to user_count when a player enters bidding, Decremented for every bid
+        self.users_to_bid = list()  # Initialize with all usernames, remove username for every bid
+        self.last_player = None
+        self.last_winner = None
+        self.last_price = 0
+        # Score status
+        self.total_score = 0.0
+        self.score_hash = None      # Hash of the score column of the sheet last updated (refer main.update_scores)
+        # A new token on every change of the players shown in the pages (refer app.fragments). A token instead of a
+        # count so that a writer does not have to read the game to change it.
+        self.revision = None
+
+    def create(self):
+        return self.update()
+
+    def update(self, doc_id=None):
+        # The counters are set along with the game in a single commit
+        if doc_id:
+            self.doc_id = doc_id
+        self.revision = self.new_revision()
+        doc_dict = self.to_dict()
+        batch = self.db.batch()
+        batch.set(self.db.collection(self.COLLECTION).document(self.doc_id), stamp(doc_dict))
+        for name, counter in self.counters.items():
+            for shard_ref, shard_dict in counter.reset(getattr(self, name)):
+                batch.set(shard_ref, shard_dict)
+        with track('commit', doc_dict):
+            batch.commit()
+        self.set_snapshot(self)
+        return self
+
+    def update_fields(self, **fields):
+        counter_fields = {name: fields.pop(name) for name in self.COUNTERS if name in fields}
+        if not counter_fields:
+            if not super().update_fields(**fields):
+                return None
+            self.update_snapshot(fields)
+            return self
+        batch = self.db.batch()
+        # The game is stamped even if only the counters are changed
+        batch.update(self.db.collection(self.COLLECTION).document(self.doc_id), stamp(fields))
+        for name, value in counter_fields.items():
+            for shard_ref, shard_dict in self.counters[name].reset(value):
+                batch.set(shard_ref, shard_dict)
+        with track('commit', fields):
+            batch.commit()
+        fields.update(counter_fields)
+        for field, value in fields.items():
+            setattr(self, field, value)
+        self.update_snapshot(fields)
+        return self
+
+    @staticmethod
+    def new_revision():
+        return uuid4().hex
+
+    def bump_revision(self):
+        return self.update_fields(revision=self.new_revision())
+
+    @classmethod
+    def read(cls, doc_id=None):
+        game = super().read(cls.SINGLE_ID)
+        if game:
+            game.sum_counters()
+        return game
+
+    @classmethod
+    def read_document(cls):
+        # The game without the counters. Their values are as of the last update of the game document.
+        return super().read(cls.SINGLE_ID)
+
+    @classmethod
+    def read_tx(cls, transaction, doc_id=None):
+        # The counters are not read. Reading all their shards in a transaction would make it contend with every bid.
+        return super().read_tx(transaction, cls.SINGLE_ID)
+
+    def refresh(self):
+        if not super().refresh():
+            return False
+        self.sum_counters()
+        return True
+
+    def sum_counters(self):
+        # Games saved before the counters were sharded keep the values in the document (refer shard_counters).
+        # Returns the names of the counters without any shard.
+        totals = ShardedCounter.totals(self.counters.values())
+        for name, value in totals.items():
+            setattr(self, name, value)
+        return [name for name in self.COUNTERS if name not in totals]
+
+    def shard_counters(self):
+        # Sets the shards of the counters without any from the values in the game document. Run it once on a game
+        # saved before the counters were sharded, else the first increment replaces the value in the document.
+        unsharded = self.sum_counters()
+        if unsharded:
+            self.update_fields(**{name: getattr(self, name) for name in unsharded})
+        return unsharded
+
+    @classmethod
+    def read_cached(cls):
+        # Use this in request handlers. Transactions should continue to read the game document themselves.
+        ttl = cls.WATCH_TTL if cls._watch else cls.CACHE_TTL
+        with cls._snapshot_lock:
+            if cls._snapshot and monotonic() - cls._snapshot_time < ttl:
+                cache_requests.inc(cache='game', result='hit')
+                return deepcopy(cls._snapshot)
+        cache_requests.inc(cache='game', result='miss')
+        game = cls.read()
+        cls.set_snapshot(game)
+        return game
+
+    @classmethod
+    def set_snapshot(cls, game):
+        with cls._snapshot_lock:
+            cls._snapshot = deepcopy(game)
+            cls._snapshot_time = monotonic()
+
+    @classmethod
+    def update_snapshot(cls, fields):
+        # The fields written by this process are seen by its next request without waiting for the listener or the TTL
+        with cls._snapshot_lock:
+            if not cls._snapshot:
+                return
+            for field, value in fields.items():
+                setattr(cls._snapshot, field, deepcopy(value))
+
+    @classmethod
+    def watch(cls):
+        # Listen to changes on the game document. Returns True if the listener is running.
+        if cls._watch:
+            return True
+        if not cls.db:
+            return False
+        try:
+            cls._watch = cls.db.collection(cls.COLLECTION).document(cls.SINGLE_ID).on_snapshot(cls._on_snapshot)
+        except AttributeError:
+            return False
+        return True
+
+    @classmethod
+    def unwatch(cls):
+        if cls._watch:
+            cls._watch.unsubscribe()
+            cls._watch = None
+
+    @classmethod
+    def _on_snapshot(cls, docs, changes, read_time):
+        # Called by firestore on a background thread with the latest snapshot of the game document
+        game = None
+        for doc in docs:
+            if doc.exists:
+                game = cls.from_dict(doc.to_dict())
+                game.doc_id = doc.id
+                # The counters are updated in the same commits as the game document
+                game.sum_counters()
+        cls.set_snapshot(game)
+
+    @property
+    def avg_player_bid(self):
+        estimate = self.total_balance / self.player_to_bid if self.player_to_bid > 0 else 0
+        if self.bid_in_progress and self.remaining_value > 0:
+            player_value = Player.query_first(name=self.player_in_bidding).value
+            estimate = self.total_balance * player_value / self.remaining_value
+        return min(int(estimate), User.INITIAL_BUDGET, self.total_balance)
+
+    # Should only be called after creating all users in db
+    def set_user_count(self):
+        users = User.get_all()
+        self.user_count = len(users)
+        self.total_balance = sum([user.balance for user in users])
+        self.update()
+        Roster.build(users)
+
+    # Should only be called after creating all players in db
+    def set_player_count(self):
+        players = Player.get_all()
+        self.player_count = len(players)
+        self.player_to_bid = self.player_count
+        self.remaining_value = sum([player.value for player in players])
+        self.update()
+
+    @staticmethod
+    def init_game():
+        game = Game()
+        game.create()
+        game.set_user_count()
+        game.set_player_count()
+        game.refresh()
+        return game
+
+
+class Roster(FirestoreModel):
+    # The balance of each user in a single document so that a transaction does not have to read all the users.
+    # Rebuild it whenever the users are uploaded. The purchase transaction keeps the balances up to date.
+    COLLECTION = 'roster'
+    DEFAULT = 'balances'
+    SINGLE_ID = '1'
+
+    def __init__(self, balances=None):
+        super().__init__(balances if balances is not None else dict())
+        self.doc_id = self.SINGLE_ID
+
+    def create(self):
+        return self.update()
+
+    @classmethod
+    def read(cls, doc_id=None):
+        return super().read(cls.SINGLE_ID)
+
+    @classmethod
+    def read_tx(cls, transaction, doc_id=None):
+        return super().read_tx(transaction, cls.SINGLE_ID)
+
+    @property
+    def usernames(self):
+        return sorted(self.balances)
+
+    @property
+    def zero_balance_usernames(self):
+        return [username for username in self.usernames if self.balances[username] == 0]
+
+    @staticmethod
+    def build(users=None):
+        if users is None:
+            users = User.get_all()
+        roster = Roster({user.username: user.balance for user in users})
+        return roster.create()
+
+
+class Bid(FirestoreModel):
+    COLLECTION = 'bids'
+    DEFAULT = 'player_name'
+    # Bid type
+    NO_BALANCE = -2
+    PASS = -1
+    OWNED = -3
+    # Accept Bid Result
+    SUCCESS = 1
+    ERROR_SYSTEM = -99
+    ERROR_ALREADY_BID = -1
+    ERROR_PLAYER_NOT_FOUND = -2
+    ERROR_NO_BALANCE = -3
+    ERROR_PLAYER_NOT_INVITED_TO_BID = -4
+    ERROR_INVALID_AMOUNT = -5
+    # Invite Bid Result
+    # On Success returns the bid object
+    ERROR_NO_MORE_PLAYERS = -11
+    ERROR_PLAYER_NOT_AVAILABLE = -12
+    ERROR_BID_IN_PROGRESS = -13
+
+    def __init__(self, player_name=None, bid_order=None):
+        super().__init__(player_name)
+        self.player_name = player_name if player_name else 'No Name'
+        self.doc_id = Player.name_to_id(self.player_name)
+        self.bid_map = list()
+        self.winner = None
+        self.winning_price = 0
+        self.bid_order = bid_order
+        # Set once the lot is closed. The bid_map is then sorted by username for display.
+        self.complete = False
+
+    def create(self):
+        return self.update()
+
+    def has_bid(self, username):
+        if not self.bid_map:
+            return False
+        usernames = [bd['username'] for bd in self.bid_map]
+        return username in usernames
+
+    def is_bid_complete(self, user_count):
+        if not self.bid_map:
+            return False
+        return len(self.bid_map) >= user_count
+
+
+class BidEntry(FirestoreModel):
+    # A bid of a user for a lot as a document of its own (refer Config.BID_INTAKE)
+    COLLECTION = 'bid_entries'
+    DEFAULT = 'player_name'
+
+    def __init__(self, player_name=None, username=None, amount=Bid.PASS):
+        super().__init__(player_name)
+        self.username = username
+        self.amount = amount
+        if player_name and username:
+            self.doc_id = f'{Player.name_to_id(player_name)}:{username}'
+
+    def create(self):
+        return self.create_unique()
+
+
+class Country:
+    CODES = ['eng', 'ind', 'nz', 'sa', 'aus', 'pak', 'sl', 'wi', 'ban', 'afg']
+    DATA = {
+        'eng': {'name': 'England', 'rank': 1, 'color': 'crimson', 'bg_color': 'navy'},
+        'ind': {'name': 'India', 'rank': 2, 'color': 'lightsalmon', 'bg_color': 'dodgerblue'},
+        'sa': {'name': 'South Africa', 'rank': 3, 'color': 'yellow', 'bg_color': 'forestgreen'},
+        'nz': {'name': 'New Zealand', 'rank': 4, 'color': 'white', 'bg_color': 'black'},
+        'aus': {'name': 'Australia', 'rank': 5, 'color': 'green', 'bg_color': 'yellow'},
+        'pak': {'name': 'Pakistan', 'rank': 6, 'color': 'gold', 'bg_color': 'darkgreen'},
+        'ban': {'name': 'Bangladesh', 'rank': 7, 'color': 'crimson', 'bg_color': 'olivedrab'},
+        'wi': {'name': 'West Indies', 'rank': 8, 'color': 'yellow', 'bg_color': 'maroon'},
+        'sl': {'name': 'Sri Lanka', 'rank': 9, 'color': 'yellow', 'bg_color': 'mediumblue'},
+        'afg': {'name': 'Afghanistan', 'rank': 10, 'color': 'crimson', 'bg_color': 'deepskyblue'},
+    }
+
+    def __init__(self, code):
+        if code.lower() in self.CODES:
+            self.code = code.lower()
+            self.init_data()
+            return
+        # Check if country name is passed instead of country code
+        name = code
+        country_list = [code for code in self.DATA if self.DATA[code]['name'].lower() == name.lower()]
+        if country_list:
+            self.code = country_list[0]
+            self.init_data()
+            return
+        # Country is not valid
+        self.code = None
+        self.name = None
+        self.rank = None
+        self.color = None
+        self.bg_color = None
+        return
+
+    def init_data(self):
+        if not self.code or self.code not in self.CODES:
+            return
+        self.name = self.DATA[self.code]['name']
+        self.rank = self.DATA[self.code]['rank']
+        self.color = self.DATA[self.code]['color']
+        self.bg_color = self.DATA[self.code]['bg_color']
+        return
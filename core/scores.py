@@ -0,0 +1,31 @@
+from core.models import User, Player
+
+
+def init_user_points():
+    users = User.get_all()
+    User.init_batch()
+    for user in users:
+        user.points = 0
+        user.update_batch()
+    User.commit_batch()
+    User.uncache()
+
+
+def sync_player_user_points():
+    # This function needs to be called after scores for the players has been updated
+    users = User.get_all()
+    User.init_batch()
+    for user in users:
+        owned_players = Player.query(owner_username=user.username)
+        if owned_players:
+            user.points = sum([player.score for player in owned_players])
+            user.update_batch()
+    User.commit_batch()
+    User.uncache()
+    players = Player.get_all()
+    Player.init_batch()
+    for player in players:
+        if isinstance(player.owner, dict) and 'points' in player.owner:
+            player.owner['points'] = next((user.points for user in users if user.username == player.owner_username), 0)
+            player.update_batch()
+    Player.commit_batch()
@@ -1,5 +1,16 @@
+import base64
+import binascii
+import json
+import random
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+from time import perf_counter
 from firebase_admin import firestore
-from google.cloud.exceptions import NotFound
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.cloud.exceptions import NotFound, Conflict
 from firebase_admin import initialize_app, credentials, get_app
 
 
@@ -19,19 +30,205 @@ def init_firestore_db(gac_key_path, name=None):
     return db_app
 
 
+# Every write of a model stamps the time of the write in this field so that the documents changed since a time can
+# be queried (refer FirestoreModel.updated_since). The field is not a part of the models.
+UPDATED_AT = 'updated_at'
+
+
+def stamp(doc_dict):
+    # Use this for the documents written directly in transactions and batches
+    return {**doc_dict, UPDATED_AT: firestore.SERVER_TIMESTAMP}
+
+
+def encode_timestamp(timestamp):
+    return timestamp.rfc3339() if timestamp else None
+
+
+def decode_timestamp(text):
+    return DatetimeWithNanoseconds.from_rfc3339(text) if text else None
+
+
+class FirestoreStats:
+    # Round trips to firestore by operation - read, query, write, delete, commit and transaction.
+    # Also the total time taken by them and the estimated size of the documents read or written.
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = Counter()
+        self.time = 0.0
+        self.bytes = 0
+
+    def add(self, operation, elapsed=0.0, size=0):
+        with self.lock:
+            self.calls[operation] += 1
+            self.time += elapsed
+            self.bytes += size
+
+    def clear(self):
+        with self.lock:
+            self.calls.clear()
+            self.time = 0.0
+            self.bytes = 0
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'calls': sum(self.calls.values()),
+                'bytes': self.bytes,
+                'time': round(self.time * 1000, 1),
+                'operations': dict(self.calls),
+            }
+
+
+# Totals for the process and the stats of the current request (refer start_request_stats) for each thread
+_stats = FirestoreStats()
+_local = local()
+
+
+def document_size(value):
+    # Estimated size in bytes as per the storage size calculation of firestore
+    if isinstance(value, dict):
+        return sum(len(key.encode()) + 1 + document_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(document_size(item) for item in value)
+    if isinstance(value, str):
+        return len(value.encode()) + 1
+    if isinstance(value, bool) or value is None:
+        return 1
+    return 8
+
+
+@contextmanager
+def track(operation, data=None):
+    # Wrap every call made to firestore in this. The documents read can be added to the yielded list.
+    documents = [data] if data else list()
+    start = perf_counter()
+    try:
+        yield documents
+    finally:
+        size = sum(32 + document_size(document) for document in documents)
+        record(operation, perf_counter() - start, size)
+
+
+def record(operation, elapsed=0.0, size=0):
+    _stats.add(operation, elapsed, size)
+    request_stats = getattr(_local, 'stats', None)
+    if request_stats:
+        request_stats.add(operation, elapsed, size)
+
+
+def firestore_stats():
+    return _stats.to_dict()
+
+
+def reset_firestore_stats():
+    _stats.clear()
+
+
+def start_request_stats():
+    _local.stats = FirestoreStats()
+    return _local.stats
+
+
+def end_request_stats():
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    return stats
+
+
+def current_request_stats():
+    return getattr(_local, 'stats', None)
+
+
+# Shared by all requests of the process to run independent reads concurrently (refer gather)
+GATHER_WORKERS = 16
+_gather_executor = ThreadPoolExecutor(max_workers=GATHER_WORKERS)
+
+
+def _call_with_stats(stats, function, *args):
+    _local.stats = stats
+    try:
+        return function(*args)
+    finally:
+        _local.stats = None
+
+
+def gather(*calls):
+    # Each call is a tuple of (function, *args). The calls are run concurrently and the results returned in order.
+    # Only use it for reads that do not depend on each other. The network wait happens outside the GIL.
+    stats = current_request_stats()
+    futures = [_gather_executor.submit(_call_with_stats, stats, call[0], *call[1:]) for call in calls]
+    return [future.result() for future in futures]
+
+
+# Calls and attempts of each transactional function. Attempts more than calls are retries due to contention.
+_transaction_lock = Lock()
+_transaction_calls = Counter()
+_transaction_attempts = Counter()
+
+
+def transactional(function):
+    # Use this instead of firestore.transactional to count the retries of a transaction
+    name = function.__name__
+
+    def attempt(transaction, *args, **kwargs):
+        with _transaction_lock:
+            _transaction_attempts[name] += 1
+        # The commit of each attempt is a round trip. Its time is not known here.
+        record('transaction')
+        return function(transaction, *args, **kwargs)
+
+    retrying_function = firestore.transactional(attempt)
+
+    @wraps(function)
+    def call(transaction, *args, **kwargs):
+        with _transaction_lock:
+            _transaction_calls[name] += 1
+        return retrying_function(transaction, *args, **kwargs)
+
+    return call
+
+
+def transaction_counts():
+    with _transaction_lock:
+        return {name: {
+            'calls': _transaction_calls[name],
+            'attempts': _transaction_attempts[name],
+            'retries': max(_transaction_attempts[name] - _transaction_calls[name], 0),
+        } for name in _transaction_calls}
+
+
+def reset_transaction_counts():
+    with _transaction_lock:
+        _transaction_calls.clear()
+        _transaction_attempts.clear()
+
+
+class LazyClient:
+    # The firestore client of the default app is only created when it is first used and not on import
+    client = None
+
+    def __get__(self, instance, owner):
+        if LazyClient.client is None:
+            try:
+                LazyClient.client = firestore.client()
+            except ValueError:
+                return None
+        return LazyClient.client
+
+
 class FirestoreModel:
     # COLLECTION should ALWAYS be overridden by the base class with the collection name
     COLLECTION = 'firestore'
     # DEFAULT FIELD can be overridden if the default name of the field needs a change
     DEFAULT = 'name'
     BATCH = None
+    BATCH_COUNT = 0
+    # Firestore allows a maximum of 500 writes in a batch. Larger batches are committed in chunks of this size.
+    BATCH_SIZE = 500
     DELETE_BATCH_SIZE = 10
     ORDER_ASCENDING = firestore.Query.ASCENDING
     ORDER_DESCENDING = firestore.Query.DESCENDING
-    try:
-        db = firestore.client()
-    except ValueError:
-        db = None
+    db = LazyClient()
 
     def __init__(self, field_value=None):
         self.doc_id = None
@@ -43,11 +240,32 @@ class FirestoreModel:
     @classmethod
     def init_db(cls, db_app=None):
         try:
-            cls.db = firestore.client(db_app)
+            LazyClient.client = firestore.client(db_app)
         except ValueError:
             return False
         return True
 
+    @classmethod
+    def _stream(cls, query, transaction=None):
+        # Returns the models of all the documents of the query
+        models = list()
+        with track('query') as documents:
+            for doc in query.stream(transaction=transaction):
+                doc_dict = doc.to_dict()
+                documents.append(doc_dict)
+                model = cls.from_dict(doc_dict)
+                model.doc_id = doc.id
+                models.append(model)
+        return models
+
+    @classmethod
+    def _get(cls, doc_ref, transaction=None):
+        with track('read') as documents:
+            doc = doc_ref.get(transaction=transaction)
+            if doc.exists:
+                documents.append(doc.to_dict())
+        return doc
+
     @classmethod
     def get_transaction(cls):
         return cls.db.transaction() if cls.db else None
@@ -71,16 +289,43 @@ class FirestoreModel:
         return model
 
     def create(self):
-        doc = self.db.collection(self.COLLECTION).add(self.to_dict())
+        doc_dict = self.to_dict()
+        with track('write', doc_dict):
+            doc = self.db.collection(self.COLLECTION).add(stamp(doc_dict))
         self.doc_id = doc[1].id
         return self
 
+    def create_unique(self):
+        # Creates the document with its doc_id in a single write without any read.
+        # Returns None if the document already exists.
+        if not self.doc_id:
+            return None
+        doc_dict = self.to_dict()
+        try:
+            with track('write', doc_dict):
+                self.db.collection(self.COLLECTION).document(self.doc_id).create(stamp(doc_dict))
+        except Conflict:
+            return None
+        return self
+
+    def update_fields(self, **fields):
+        # Writes only the given fields. The other fields of the document are not overwritten.
+        if not self.doc_id:
+            return None
+        with track('write', fields):
+            self.db.collection(self.COLLECTION).document(self.doc_id).update(stamp(fields))
+        for field, value in fields.items():
+            setattr(self, field, value)
+        return self
+
     def update(self, doc_id=None):
         if doc_id:
             self.doc_id = doc_id
         elif not self.doc_id:
             return None
-        self.db.collection(self.COLLECTION).document(self.doc_id).set(self.to_dict())
+        doc_dict = self.to_dict()
+        with track('write', doc_dict):
+            self.db.collection(self.COLLECTION).document(self.doc_id).set(stamp(doc_dict))
         return self
 
     @classmethod
@@ -88,7 +333,23 @@ class FirestoreModel:
         if not doc_id:
             return None
         try:
-            doc = cls.db.collection(cls.COLLECTION).document(doc_id).get()
+            doc = cls._get(cls.db.collection(cls.COLLECTION).document(doc_id))
+        except NotFound:
+            return None
+        if not doc.exists:
+            return None
+        model = cls.from_dict(doc.to_dict())
+        model.doc_id = doc.id
+        return model
+
+    @classmethod
+    def read_tx(cls, transaction, doc_id=None):
+        # Reads the model in the transaction. A transaction should read each of its documents only once with this
+        # (or query_tx) and write them with the references from get_doc.
+        if not doc_id:
+            return None
+        try:
+            doc = cls._get(cls.db.collection(cls.COLLECTION).document(doc_id), transaction)
         except NotFound:
             return None
         if not doc.exists:
@@ -97,11 +358,29 @@ class FirestoreModel:
         model.doc_id = doc.id
         return model
 
+    @classmethod
+    def read_many(cls, doc_ids):
+        # Reads all the documents in a single call. Documents not found are skipped. The order of doc_ids is kept.
+        if not doc_ids:
+            return list()
+        doc_refs = [cls.db.collection(cls.COLLECTION).document(doc_id) for doc_id in doc_ids]
+        models = dict()
+        with track('read') as documents:
+            for doc in cls.db.get_all(doc_refs):
+                if not doc.exists:
+                    continue
+                doc_dict = doc.to_dict()
+                documents.append(doc_dict)
+                model = cls.from_dict(doc_dict)
+                model.doc_id = doc.id
+                models[doc.id] = model
+        return [models[doc_id] for doc_id in doc_ids if doc_id in models]
+
     def refresh(self):
         if not self.doc_id:
             return False
         try:
-            doc = self.db.collection(self.COLLECTION).document(self.doc_id).get()
+            doc = self._get(self.db.collection(self.COLLECTION).document(self.doc_id))
         except NotFound:
             return False
         if not doc.exists:
@@ -120,7 +399,7 @@ class FirestoreModel:
         doc = None
         if transaction:
             try:
-                doc = self.db.collection(self.COLLECTION).document(self.doc_id).get(transaction=transaction)
+                doc = self._get(doc_ref, transaction)
             except NotFound:
                 pass
             if doc and not doc.exists:
@@ -132,25 +411,16 @@ class FirestoreModel:
             self.doc_id = doc_id
         elif not self.doc_id:
             return None
-        self.db.collection(self.COLLECTION).document(self.doc_id).delete()
+        with track('delete'):
+            self.db.collection(self.COLLECTION).document(self.doc_id).delete()
         self.doc_id = None
         return self
 
     @classmethod
     def get_all(cls, dict_type=False):
-        docs = cls.db.collection(cls.COLLECTION).stream()
-        if not dict_type:
-            models = list()
-            for doc in docs:
-                model = cls.from_dict(doc.to_dict())
-                model.doc_id = doc.id
-                models.append(model)
-        else:
-            models = dict()
-            for doc in docs:
-                model = cls.from_dict(doc.to_dict())
-                model.doc_id = doc.id
-                models[doc.id] = model
+        models = cls._stream(cls.db.collection(cls.COLLECTION))
+        if dict_type:
+            models = {model.doc_id: model for model in models}
         return models
 
     @classmethod
@@ -159,26 +429,22 @@ class FirestoreModel:
         for field in kwargs:
             if field in cls().__dict__ and field != 'doc_id':
                 doc_ref = doc_ref.where(field, '==', kwargs[field])
-        docs = doc_ref.stream()
-        models = list()
-        for doc in docs:
-            model = cls.from_dict(doc.to_dict())
-            model.doc_id = doc.id
-            models.append(model)
-        return models
+        return cls._stream(doc_ref)
+
+    @classmethod
+    def query_tx(cls, transaction, **kwargs):
+        doc_ref = cls.db.collection(cls.COLLECTION)
+        for field in kwargs:
+            if field in cls().__dict__ and field != 'doc_id':
+                doc_ref = doc_ref.where(field, '==', kwargs[field])
+        return cls._stream(doc_ref, transaction)
 
     @classmethod
     def query_array(cls, array):
         doc_ref = cls.db.collection(cls.COLLECTION)
         if array and isinstance(array, tuple) and len(array) == 2:
             doc_ref = doc_ref.where(array[0], 'array_contains', array[1])
-        docs = doc_ref.stream()
-        models = list()
-        for doc in docs:
-            model = cls.from_dict(doc.to_dict())
-            model.doc_id = doc.id
-            models.append(model)
-        return models
+        return cls._stream(doc_ref)
 
     @classmethod
     def order_by(cls, *criteria, query={}, array=(), page=None):
@@ -209,78 +475,85 @@ class FirestoreModel:
         # All scenarios for multiple order_by is recommended to be tested in unittest.
         if page is None or not isinstance(page, FirestorePage) or len(criteria) != 1\
                 or page.want not in [FirestorePage.NEXT_PAGE, FirestorePage.PREV_PAGE]:
-            docs = doc_ref.stream()
-            models = list()
-            for doc in docs:
-                model = cls.from_dict(doc.to_dict())
-                model.doc_id = doc.id
-                models.append(model)
-            return models
-        # Pagination logic
-        if page.want == FirestorePage.NEXT_PAGE or page.current_start is None:
-            if page.current_end is None:
-                query = doc_ref.limit(page.per_page)
+            return cls._stream(doc_ref)
+        # Pagination logic - a single query per page.
+        # The page cursor holds the sort field value and the doc_id of the row to start after.
+        # One extra row is fetched to know if there is another page in the direction of travel.
+        page.field = field
+        cursor = page.decode_cursor(page.cursor)
+        if page.want == FirestorePage.PREV_PAGE and not cursor:
+            # There is nothing before the first page
+            page.items = list()
+            return page
+        cursor_values = None
+        if cursor:
+            cursor_ref = cls.db.collection(cls.COLLECTION).document(cursor[1])
+            cursor_values = {field: cursor[0], FirestorePage.DOC_ID: cursor_ref}
+        forward = doc_ref.order_by(FirestorePage.DOC_ID, direction=order)
+        if page.want == FirestorePage.PREV_PAGE:
+            # The row of the cursor is read along to know if there is a next page
+            reverse = cls.ORDER_ASCENDING if order == cls.ORDER_DESCENDING else cls.ORDER_DESCENDING
+            query = saved_ref.order_by(field, direction=reverse).order_by(FirestorePage.DOC_ID, direction=reverse)
+            models = cls._stream(query.start_at(cursor_values).limit(page.per_page + 2))
+            page.has_next = bool(models) and models[0].doc_id == cursor[1]
+            if page.has_next:
+                models = models[1:]
             else:
-                end_ref, _ = page.current_end.get_doc()
-                query = doc_ref.limit(page.per_page).start_after(end_ref.get())
-            models = list()
+                # The row of the cursor is no longer in the query
+                page.has_next = bool(cls._stream(forward.start_after(cursor_values).limit(1)))
+            page.has_prev = len(models) > page.per_page
+            models = models[:page.per_page]
+            models.reverse()
+        else:
+            query = forward.start_after(cursor_values) if cursor else forward
+            models = cls._stream(query.limit(page.per_page + 1))
+            page.has_next = len(models) > page.per_page
+            page.has_prev = cursor is not None
+            models = models[:page.per_page]
+        page.current_start = models[0] if models else None
+        page.current_end = models[-1] if models else None
+        page.items = models
+        return page
+
+    @classmethod
+    def updated_since(cls, timestamp=None):
+        # Returns the models written after the timestamp (all the stamped ones without it) and the time of the
+        # latest write among them. Deleted documents are not known.
+        query = cls.db.collection(cls.COLLECTION)
+        if timestamp:
+            query = query.where(UPDATED_AT, '>', timestamp)
+        else:
+            query = query.order_by(UPDATED_AT)
+        models = list()
+        latest = timestamp
+        with track('query') as documents:
             for doc in query.stream():
-                model = cls.from_dict(doc.to_dict())
+                doc_dict = doc.to_dict()
+                documents.append(doc_dict)
+                model = cls.from_dict(doc_dict)
                 model.doc_id = doc.id
                 models.append(model)
-                if len(models) == 1:
-                    page.current_start = model
-                page.current_end = model
-            try:
-                end_ref, _ = page.current_end.get_doc()
-                next(doc_ref.limit(1).start_after(end_ref.get()).stream())
-                page.has_next = True
-            except (StopIteration, AttributeError):
-                page.has_next = False
-            try:
-                reverse = cls.ORDER_ASCENDING if order == cls.ORDER_DESCENDING else cls.ORDER_DESCENDING
-                reverse_ref = saved_ref.order_by(field, direction=reverse)
-                end_ref, _ = page.current_start.get_doc()
-                next(reverse_ref.limit(1).start_after(end_ref.get()).stream())
-                page.has_prev = True
-            except (StopIteration, AttributeError):
-                page.has_prev = False
-            page.items = models
-            return page
-        # Previous Page logic
-        if order == cls.ORDER_DESCENDING:
-            reverse = cls.ORDER_ASCENDING
-            reverse_sort = True
+                if latest is None or doc_dict[UPDATED_AT] > latest:
+                    latest = doc_dict[UPDATED_AT]
+        return models, latest
+
+    @classmethod
+    def last_updated(cls, doc_id=None, **kwargs):
+        # Time of the latest write in the collection. With a doc_id or fields, the time of the latest write of the
+        # document or of the documents with those values. Only the time is read.
+        if not doc_id and not kwargs:
+            query = cls.db.collection(cls.COLLECTION).order_by(UPDATED_AT, direction=cls.ORDER_DESCENDING).limit(1)
         else:
-            reverse = cls.ORDER_DESCENDING
-            reverse_sort = False
-        reverse_ref = saved_ref.order_by(field, direction=reverse)
-        start_ref, _ = page.current_start.get_doc()
-        query = reverse_ref.limit(page.per_page).start_after(start_ref.get())
-        models = list()
-        for doc in query.stream():
-            model = cls.from_dict(doc.to_dict())
-            model.doc_id = doc.id
-            models.append(model)
-            if len(models) == 1:
-                page.current_end = model
-            page.current_start = model
-        try:
-            start_ref, _ = page.current_start.get_doc()
-            next(reverse_ref.limit(1).start_after(start_ref.get()).stream())
-            page.has_prev = True
-        except (StopIteration, AttributeError):
-            page.has_prev = False
-        try:
-            end_ref, _ = page.current_start.get_doc()
-            next(doc_ref.limit(1).start_after(end_ref.get()).stream())
-            page.has_next = True
-        except (StopIteration, AttributeError):
-            page.has_next = False
-        if len(models) > 0:
-            models.sort(key=lambda item: getattr(item, field), reverse=reverse_sort)
-        page.items = models
-        return page
+            query = cls.db.collection(cls.COLLECTION).select([UPDATED_AT])
+            if doc_id:
+                query = query.where(FirestorePage.DOC_ID, '==', cls.db.collection(cls.COLLECTION).document(doc_id))
+            for field, value in kwargs.items():
+                query = query.where(field, '==', value)
+        with track('query') as documents:
+            docs = [doc.to_dict() for doc in query.stream()]
+            documents.extend(docs)
+        times = [doc[UPDATED_AT] for doc in docs if UPDATED_AT in doc]
+        return max(times) if times else None
 
     @classmethod
     def query_first(cls, **kwargs):
@@ -288,22 +561,19 @@ class FirestoreModel:
         for field in kwargs:
             if field in cls().__dict__ and field != 'doc_id':
                 doc_ref = doc_ref.where(field, '==', kwargs[field])
-        docs = doc_ref.limit(1).stream()
-        try:
-            doc = next(docs)
-        except StopIteration:
-            return None
-        model = cls.from_dict(doc.to_dict())
-        model.doc_id = doc.id
-        return model
+        models = cls._stream(doc_ref.limit(1))
+        return models[0] if models else None
 
     @classmethod
     def delete_all(cls, batch_size=None):
         if batch_size is None or batch_size < 1:
             batch_size = cls.DELETE_BATCH_SIZE
         deleted = 0
-        for doc in cls.db.collection(cls.COLLECTION).limit(batch_size).stream():
-            doc.reference.delete()
+        with track('query'):
+            docs = list(cls.db.collection(cls.COLLECTION).limit(batch_size).stream())
+        for doc in docs:
+            with track('delete'):
+                doc.reference.delete()
             deleted += 1
         if deleted == batch_size:   # if more to delete
             return cls.delete_all(batch_size)
@@ -311,32 +581,103 @@ class FirestoreModel:
     @classmethod
     def init_batch(cls):
         cls.BATCH = cls.db.batch()
+        cls.BATCH_COUNT = 0
 
     def update_batch(self):
         if not self.doc_id:
             return None
-        if not self.BATCH:
-            self.BATCH = self.db.batch()
+        cls = type(self)
+        if not cls.BATCH:
+            cls.init_batch()
         model_ref = self.db.collection(self.COLLECTION).document(self.doc_id)
-        self.BATCH.set(model_ref, self.to_dict())
+        cls.BATCH.set(model_ref, stamp(self.to_dict()))
+        cls.BATCH_COUNT += 1
+        if cls.BATCH_COUNT >= cls.BATCH_SIZE:
+            cls.commit_batch()
+            cls.init_batch()
+        return self
+
+    def delete_batch(self):
+        if not self.doc_id:
+            return None
+        cls = type(self)
+        if not cls.BATCH:
+            cls.init_batch()
+        cls.BATCH.delete(self.db.collection(self.COLLECTION).document(self.doc_id))
+        cls.BATCH_COUNT += 1
+        if cls.BATCH_COUNT >= cls.BATCH_SIZE:
+            cls.commit_batch()
+            cls.init_batch()
         return self
 
     @classmethod
     def commit_batch(cls):
         if not cls.BATCH:
             return False
-        cls.BATCH.commit()
+        if cls.BATCH_COUNT:
+            with track('commit'):
+                cls.BATCH.commit()
         cls.BATCH = None
+        cls.BATCH_COUNT = 0
         return True
 
 
+class ShardedCounter:
+    # A counter saved as the sum of SHARDS documents. An increment reads and writes a single random shard so that
+    # concurrent increments seldom touch the same document.
+    COLLECTION = 'counters'
+    SHARDS = 10
+
+    def __init__(self, name, shards=None):
+        self.name = name
+        self.shards = shards or self.SHARDS
+
+    def shard_ref(self, index):
+        return FirestoreModel.db.collection(self.COLLECTION).document(f'{self.name}_{index}')
+
+    def increment(self, transaction, amount):
+        # Returns the (reference, data) to be written with the other writes of the transaction.
+        # The shard is read here since all the reads of a transaction must be done before its writes.
+        shard_ref = self.shard_ref(random.randrange(self.shards))
+        try:
+            doc = FirestoreModel._get(shard_ref, transaction)
+        except NotFound:
+            doc = None
+        value = doc.get('value') if doc and doc.exists else 0
+        return shard_ref, {'value': value + amount}
+
+    def reset(self, value=0):
+        # Returns the (reference, data) of each shard to set the counter to value. No read is required.
+        return [(self.shard_ref(index), {'value': value if index == 0 else 0}) for index in range(self.shards)]
+
+    @classmethod
+    def totals(cls, counters):
+        # Returns the value of each counter with the shards of all of them read in a single call.
+        # Counters without any shard are not in the result.
+        shard_refs = [counter.shard_ref(index) for counter in counters for index in range(counter.shards)]
+        values = dict()
+        with track('read') as documents:
+            for doc in FirestoreModel.db.get_all(shard_refs):
+                if not doc.exists:
+                    continue
+                doc_dict = doc.to_dict()
+                documents.append(doc_dict)
+                name = doc.id.rsplit('_', 1)[0]
+                values[name] = values.get(name, 0) + doc_dict.get('value', 0)
+        return values
+
+
 class FirestorePage:
     PER_PAGE = 25
     NEXT_PAGE = 1
     PREV_PAGE = -1
+    # Field path used by firestore to order by the document id
+    DOC_ID = '__name__'
 
-    def __init__(self, per_page=None):
+    def __init__(self, per_page=None, cursor=None):
         self.per_page = per_page if per_page is not None else self.PER_PAGE
+        self.cursor = cursor
+        self.field = None
         self.current_start = None
         self.current_end = None
         self.has_next = False
@@ -344,7 +685,35 @@ class FirestorePage:
         self.items = None
         self.want = self.NEXT_PAGE
 
+    @staticmethod
+    def encode_cursor(value, doc_id):
+        token = json.dumps([value, doc_id], separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(token).decode().rstrip('=')
 
+    @staticmethod
+    def decode_cursor(token):
+        # Returns a tuple of (value, doc_id) or None if the token is missing or has been tampered
+        if not token:
+            return None
+        try:
+            value, doc_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        except (ValueError, TypeError, binascii.Error):
+            return None
+        # A document id cannot have a / and the value of an ordered field in a page is never a list or a map
+        if not doc_id or not isinstance(doc_id, str) or '/' in doc_id or doc_id in ('.', '..'):
+            return None
+        if value is not None and not isinstance(value, (str, int, float)):
+            return None
+        return value, doc_id
 
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.current_end or not self.field:
+            return None
+        return self.encode_cursor(getattr(self.current_end, self.field), self.current_end.doc_id)
 
-
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or not self.current_start or not self.field:
+            return None
+        return self.encode_cursor(getattr(self.current_start, self.field), self.current_start.doc_id)
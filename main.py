@@ -1,52 +1,66 @@
+import hashlib
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from config import config
 from firestore_model import init_firestore_db
-from app.models import Player, Game
-from app.main.game_transactions import sync_player_user_points
+from core.models import Player, Game
+from core.scores import sync_player_user_points
 
+SCOPE = ['https://spreadsheets.google.com/feeds',
+         'https://www.googleapis.com/auth/drive']
+# Column of the score in the scores worksheet (player, score)
+SCORE_COLUMN = 2
+# Kept across warm invocations of the function
+_client = None
+_sheet = None
+_score_hash = None
 
-def update_scores(data, context):
-    # Use creds to create a client to interact with the Google Drive API
-    scope = ['https://spreadsheets.google.com/feeds',
-             'https://www.googleapis.com/auth/drive']
 
-    creds = ServiceAccountCredentials.from_json_keyfile_name(config.GAC_KEY_PATH, scope)
-    client = gspread.authorize(creds)
+def scores_sheet():
+    global _client, _sheet
+    if _sheet is None:
+        # Use creds to create a client to interact with the Google Drive API
+        creds = ServiceAccountCredentials.from_json_keyfile_name(config.GAC_KEY_PATH, SCOPE)
+        _client = gspread.authorize(creds)
+        # Open the work book
+        _sheet = _client.open("wc2019").worksheet("scores")
+        # Init database
+        init_firestore_db(config.GAC_KEY_PATH)
+    elif _client.auth.access_token_expired:
+        # An instance can stay warm longer than the token is valid
+        _client.login()
+    return _sheet
 
-    # Open the work book
-    sheet = client.open("wc2019").worksheet("scores")
-    players_dict = sheet.get_all_records()
 
-    # Init database
-    init_firestore_db(config.GAC_KEY_PATH)
+def update_scores(data, context):
+    global _score_hash
+    sheet = scores_sheet()
 
-    # Check if update required
+    # Check if update required. Only the score column is read for this.
+    score_hash = hashlib.sha256('\n'.join(sheet.col_values(SCORE_COLUMN)).encode()).hexdigest()
+    if score_hash == _score_hash:
+        return False
     game = Game.read()
     if not game:
         return False
+    if game.score_hash == score_hash:
+        _score_hash = score_hash
+        return False
+    players_dict = sheet.get_all_records()
     try:
         total_score = sum([float(player['score']) for player in players_dict])
     except ValueError:
         total_score = 0
-    if total_score != 0 and game.total_score == total_score:
-        return False
 
     # Update player score
-    players = Player.get_all()
-    Player.init_batch()
-    for player in players:
-        player_item = next((item for item in players_dict if item['player'] == player.name), None)
-        if not player_item:
-            continue
+    scores = list()
+    for item in players_dict:
         try:
-            player.score = round(float(player_item['score']), 1)
-            player.update_batch()
+            scores.append({'player': item['player'], 'score': round(float(item['score']), 1)})
         except ValueError:
             continue
-    Player.commit_batch()
+    Player.update_scores(scores)
     sync_player_user_points()
-    game.total_score = total_score
-    game.update()
+    game.update_fields(total_score=total_score, score_hash=score_hash, revision=Game.new_revision())
+    _score_hash = score_hash
     return True
-
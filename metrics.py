@@ -0,0 +1,139 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+
+class Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.lock = Lock()
+
+    @staticmethod
+    def labels_key(labels):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                   for name, value in labels]
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+    def samples(self):
+        # Returns a list of (name, labels, value)
+        return list()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.TYPE}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{self.format_labels(labels)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name, description):
+        super().__init__(name, description)
+        self.values = dict()
+
+    def inc(self, amount=1, **labels):
+        key = self.labels_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    # Seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, description, buckets=None):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets)) if buckets else self.BUCKETS
+        # For each labels key - count of each bucket (the last one is +Inf), sum and count
+        self.values = dict()
+
+    def observe(self, value, **labels):
+        key = self.labels_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            bucket_counts = self.values[key]
+            bucket_counts[0][index] += 1
+            bucket_counts[1] += value
+            bucket_counts[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = list()
+        with self.lock:
+            for key, (bucket_counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), bucket_counts):
+                    cumulative += bucket_count
+                    samples.append((f'{self.name}_bucket', key + (('le', bound),), cumulative))
+                samples.append((f'{self.name}_sum', key, round(total, 6)))
+                samples.append((f'{self.name}_count', key, count))
+        return samples
+
+
+class Gauge(Metric):
+    # The value is read from a function when the metrics are rendered.
+    # The function returns a list of (labels dict, value).
+    TYPE = 'gauge'
+
+    def __init__(self, name, description, function, metric_type=None):
+        super().__init__(name, description)
+        self.function = function
+        if metric_type:
+            self.TYPE = metric_type
+
+    def samples(self):
+        return [(self.name, self.labels_key(labels), value) for labels, value in self.function()]
+
+
+class Registry:
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = dict()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description):
+        return self.register(Counter(name, description))
+
+    def histogram(self, name, description, buckets=None):
+        return self.register(Histogram(name, description, buckets))
+
+    def gauge(self, name, description, function, metric_type=None):
+        return self.register(Gauge(name, description, function, metric_type))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+# Process wide registry. Rendered in the prometheus text format at /metrics.
+registry = Registry()
+cache_requests = registry.counter('wc_cache_requests_total', 'Reads of in process caches by cache and result.')
@@ -0,0 +1,76 @@
+import gzip
+import struct
+import zlib
+import msgpack
+
+# Binary format of a download. A gzip stream of a header followed by length prefixed records.
+# Each record is the msgpack of [collection, document] so that the documents can be read one at a time.
+# Each collection starts with a record without a document so that empty collections are kept.
+EXTENSION = '.snap'
+MAGIC = b'WCSNAP'
+VERSION = 1
+HEADER = struct.Struct('>6sB')
+LENGTH = struct.Struct('>I')
+COMPRESS_LEVEL = 6
+
+
+def is_snapshot(file_name):
+    return file_name.endswith(EXTENSION)
+
+
+def write_snapshot(file_name, data):
+    # data is a dict of collection and its list of documents
+    with gzip.open(file_name, 'wb', compresslevel=COMPRESS_LEVEL) as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, VERSION))
+        for collection, documents in data.items():
+            for document in [None] + list(documents):
+                record = msgpack.packb([collection, document], use_bin_type=True)
+                snapshot_file.write(LENGTH.pack(len(record)))
+                snapshot_file.write(record)
+
+
+def read_snapshot(file_name):
+    # Yields (collection, document) and (collection, None) at the start of each collection.
+    # Raises ValueError if it is not a snapshot of this version, or it is truncated or corrupt.
+    with gzip.open(file_name, 'rb') as snapshot_file:
+        try:
+            yield from _read_records(snapshot_file)
+        except (zlib.error, EOFError, OSError) as error:
+            raise ValueError('Corrupt snapshot') from error
+
+
+def _read_records(snapshot_file):
+    header = snapshot_file.read(HEADER.size)
+    if len(header) != HEADER.size:
+        raise ValueError('Not a snapshot')
+    magic, version = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError('Not a snapshot')
+    if version != VERSION:
+        raise ValueError(f'Snapshot version {version} is not supported')
+    while True:
+        prefix = snapshot_file.read(LENGTH.size)
+        if not prefix:
+            return
+        if len(prefix) != LENGTH.size:
+            raise ValueError('Truncated snapshot')
+        length = LENGTH.unpack(prefix)[0]
+        record = snapshot_file.read(length)
+        if len(record) != length:
+            raise ValueError('Truncated snapshot')
+        try:
+            collection, document = msgpack.unpackb(record, raw=False)
+        except (ValueError, TypeError) as error:
+            raise ValueError('Corrupt snapshot') from error
+        if not isinstance(collection, str) or not isinstance(document, (dict, type(None))):
+            raise ValueError('Corrupt snapshot')
+        yield collection, document
+
+
+def load_snapshot(file_name):
+    data = dict()
+    for collection, document in read_snapshot(file_name):
+        documents = data.setdefault(collection, list())
+        if document is not None:
+            documents.append(document)
+    return data
@@ -1,10 +1,23 @@
 import unittest
+import csv
+import gzip
+import json
 import os
+import tempfile
+from unittest import mock
 from random import randrange
 from app.main.game_transactions import *
 from app import create_app
-from app.models import User, Player, Game, Bid, Country
-from config import TestConfig
+from app.models import User, Player, Game, Bid, BidEntry, Roster, Country, load_user
+from app.replica import Replica
+from app import compression, instrumentation
+from app.fragments import FragmentCache
+from core.images import Thumbnails
+from flask import g, Response
+from snapshot import is_snapshot, write_snapshot, read_snapshot, load_snapshot, HEADER
+from config import Config, TestConfig
+from firestore_model import firestore_stats, reset_firestore_stats
+import main
 
 
 class UserTest(unittest.TestCase):
@@ -65,6 +78,17 @@ class UserTest(unittest.TestCase):
         self.assertTrue(db_user, f'Doc Id: {user.username} not found in the db')
         self.assertDictEqual(test_user.to_dict(), db_user.to_dict())
 
+    def test_load_user(self):
+        # Load a user from the login manager and check that the cached copy is refreshed on update
+        user = User(name='Vinayak', username='vp')
+        user.create()
+        db_user = load_user('vp')
+        self.assertDictEqual(user.to_dict(), db_user.to_dict())
+        user.balance = 5000
+        user.update()
+        self.assertEqual(5000, load_user('vp').balance)
+        self.assertIsNone(load_user('xx'))
+
     def test_user_get_all(self):
         # Setup users and test_users
         users = dict()
@@ -166,6 +190,25 @@ class UserTest(unittest.TestCase):
         for index, db_user in enumerate(db_users):
             self.assertDictEqual(test_users[index].to_dict(), db_user.to_dict())
 
+    def test_tampered_cursor(self):
+        cursor = FirestorePage.encode_cursor(1, 'virat_kohli')
+        self.assertEqual((1, 'virat_kohli'), FirestorePage.decode_cursor(cursor))
+        for value, doc_id in [(1, 'players/virat_kohli'), (1, '..'), ([1], 'virat_kohli'), ({'a': 1}, 'virat_kohli'),
+                              (1, ['virat_kohli']), (1, '')]:
+            self.assertIsNone(FirestorePage.decode_cursor(FirestorePage.encode_cursor(value, doc_id)))
+        self.assertIsNone(FirestorePage.decode_cursor('not a cursor'))
+        # A tampered cursor is the first page
+        Player.from_dict({'name': 'Virat Kohli', 'bid_order': 1}).create()
+        cursor = FirestorePage.encode_cursor(1, 'players/virat_kohli')
+        page = available_players_view(10, cursor=cursor, direction=FirestorePage.NEXT_PAGE)
+        self.assertEqual(['virat_kohli'], [player.doc_id for player in page.items])
+        self.assertIsNone(available_players_view(10, cursor=cursor, direction=FirestorePage.PREV_PAGE))
+        # A value of another type in the replica
+        replica_page = Replica.page(page.items, 'bid_order', 10, FirestorePage.encode_cursor('one', 'virat_kohli'),
+                                    FirestorePage.NEXT_PAGE)
+        self.assertListEqual(list(), replica_page.items)
+        Player('Virat Kohli').delete()
+
 
 class GameTest(unittest.TestCase):
     def setUp(self) -> None:
@@ -199,6 +242,70 @@ class GameTest(unittest.TestCase):
         self.assertEqual(game.avg_player_bid, User.INITIAL_BUDGET)
         self.assertEqual(rohit.status, Player.AVAILABLE)
 
+    def test_shard_counters(self):
+        User(name='Sneha Yadgire', username='sy').create()
+        Player('Rohit Sharma').create()
+        game = Game.init_game()
+        self.assertListEqual(list(), game.shard_counters())
+        # A game saved before the counters were sharded
+        for counter in Game.counters.values():
+            for index in range(counter.shards):
+                counter.shard_ref(index).delete()
+        game.get_doc()[0].update({'user_to_bid': 1, 'total_balance': 9000})
+        game = Game.read()
+        self.assertEqual(1, game.user_to_bid)
+        self.assertEqual(9000, game.total_balance)
+        self.assertListEqual(list(Game.COUNTERS), game.shard_counters())
+        self.assertListEqual(list(), Game.read().shard_counters())
+        # The first purchase is applied to the values of the document
+        purchase_player(Player.read(Player.name_to_id('Rohit Sharma')), User.read('sy'), 1000)
+        game = Game.read()
+        self.assertEqual(8000, game.total_balance)
+        self.assertEqual(0, game.player_to_bid)
+        self.assertEqual(0, game.user_to_bid)
+
+    def test_cached_game(self):
+        User(name='Sneha Yadgire', username='sy').create()
+        Player('Rohit Sharma').create()
+        game = Game.init_game()
+        self.assertEqual(game.revision, Game.read_cached().revision)
+        # The writes of this process are in the snapshot before the TTL
+        game.bump_revision()
+        game.update_fields(bid_in_progress=True, user_to_bid=1)
+        cached = Game.read_cached()
+        self.assertEqual(game.revision, cached.revision)
+        self.assertTrue(cached.bid_in_progress)
+        self.assertEqual(1, cached.user_to_bid)
+        self.assertEqual(1, cached.player_count)
+
+    def test_update_scores(self):
+        User(name='Sneha Yadgire', username='sy').create()
+        Player('Rohit Sharma').create()
+        game = Game.init_game()
+
+        class ScoresSheet:
+            @staticmethod
+            def col_values(column):
+                return ['score', '10.5']
+
+            @staticmethod
+            def get_all_records():
+                # A lot is opened while the scores are being read
+                Game.read_document().update_fields(bid_in_progress=True, player_in_bidding='Rohit Sharma')
+                return [{'player': 'Rohit Sharma', 'score': '10.5'}]
+
+        main._score_hash = None
+        with mock.patch.object(main, 'scores_sheet', return_value=ScoresSheet()):
+            self.assertTrue(main.update_scores(None, None))
+            self.assertFalse(main.update_scores(None, None))
+        updated = Game.read()
+        self.assertEqual(10.5, updated.total_score)
+        self.assertIsNotNone(updated.score_hash)
+        self.assertNotEqual(game.revision, updated.revision)
+        self.assertTrue(updated.bid_in_progress)
+        self.assertEqual('Rohit Sharma', updated.player_in_bidding)
+        self.assertEqual(10.5, Player.read(Player.name_to_id('Rohit Sharma')).score)
+
     def test_player_purchase(self):
         # Setup user, player, game
         sneha = User(name='Sneha Yadgire', username='sy')
@@ -240,6 +347,7 @@ class GameTest(unittest.TestCase):
 
         # Test after purchase player
         self.assertEqual(18000, game.total_balance)
+        self.assertEqual(18000, Game.read().total_balance)
         self.assertEqual(len(players), game.player_to_bid)
         self.assertFalse(game.player_in_bidding)
         self.assertEqual(0, game.user_to_bid)
@@ -247,6 +355,7 @@ class GameTest(unittest.TestCase):
         self.assertEqual(sneha.username.upper(), game.last_winner)
         self.assertEqual(2000, game.last_price)
         self.assertEqual(8000, sneha.balance)
+        self.assertEqual({'sy': 8000, 'ma': 10000}, Roster.read().balances)
         self.assertEqual(1, sneha.player_count)
         self.assertEqual(Player.PURCHASED, rohit.status)
         self.assertDictEqual(winner, rohit.owner)
@@ -323,6 +432,8 @@ class GameTest(unittest.TestCase):
             'nz': 0,
             'rg': 25,
         }
+        players = Player.read_names([score['player'] for score in score_map] + ['No Player'])
+        self.assertEqual(5, len(players))
         self.assertTrue(Player.update_scores(score_map))
         sync_player_user_points()
 
@@ -422,10 +533,43 @@ class BidTest(unittest.TestCase):
         Player.delete_all()
         Game.delete_all()
         Bid.delete_all()
+        BidEntry.delete_all()
 
     def tearDown(self) -> None:
         self.app_context.pop()
 
+    def test_bid_entries(self):
+        for player in [{'name': 'Virat Kohli', 'bid_order': 1}, {'name': 'Rohit Sharma', 'bid_order': 2}]:
+            Player.from_dict(player).create()
+        for user in [{'username': 'nz', 'name': 'Nayan'}, {'username': 'pp', 'name': 'Pranay'}]:
+            User.from_dict(user).create()
+        Game.init_game()
+        bid = invite_bid()
+        self.assertEqual(Bid.SUCCESS, submit_bid(bid, User.query_first(username='nz'), 1500))
+        self.assertEqual(Bid.ERROR_ALREADY_BID, submit_bid(bid, User.query_first(username='nz'), 1600))
+        self.assertEqual(Bid.SUCCESS, aggregate_bids())
+        game = Game.read()
+        bid.refresh()
+        self.assertEqual(['pp'], game.users_to_bid)
+        self.assertEqual(1, game.user_to_bid)
+        self.assertIn({'username': 'nz', 'amount': 1500}, bid.bid_map)
+        # Folding again does not add the entry twice. The game and the lot are read once and the counters not at all.
+        reset_firestore_stats()
+        self.assertEqual(Bid.SUCCESS, aggregate_bids())
+        self.assertDictEqual({'read': 2, 'query': 1}, firestore_stats()['operations'])
+        bid.refresh()
+        self.assertEqual(1, len(bid.bid_map))
+        self.assertEqual(Bid.SUCCESS, submit_bid(bid, User.query_first(username='pp'), 1200))
+        next_bid = aggregate_bids()
+        self.assertIsInstance(next_bid, Bid)
+        self.assertEqual('Rohit Sharma', next_bid.player_name)
+        game.refresh()
+        bid.refresh()
+        self.assertEqual('NZ', game.last_winner)
+        self.assertEqual(1500, game.last_price)
+        self.assertTrue(bid.complete)
+        self.assertEqual(8500, User.query_first(username='nz').balance)
+
     def test_bid(self):
         # Setup players, users and game in db
         player_list = [
@@ -446,11 +590,14 @@ class BidTest(unittest.TestCase):
         for user in user_list:
             User.from_dict(user).create()
         game = Game.init_game()
+        self.assertEqual(['nz', 'pp', 'rg', 'sa'], Roster.read().usernames)
+        revision = game.revision
 
         # Invite bid and check
         bid = invite_bid()
         game.refresh()
         self.assertIsInstance(bid, Bid)
+        self.assertNotEqual(revision, game.revision)
         self.assertEqual('Virat Kohli', game.player_in_bidding)
         self.assertEqual(4, game.user_to_bid)
         self.assertEqual(5, game.player_to_bid)
@@ -467,6 +614,10 @@ class BidTest(unittest.TestCase):
         self.assertTrue(bid.has_bid('nz'))
         self.assertEqual(3, game.user_to_bid)
         self.assertIn({'username': 'nz', 'amount': 1500}, bid.bid_map)
+        # The balance is validated with the latest user and not the one of the request
+        stale_user = User.query_first(username='pp')
+        stale_user.balance = User.INITIAL_BUDGET * 2
+        self.assertEqual(Bid.ERROR_NO_BALANCE, accept_bid(bid, stale_user, User.INITIAL_BUDGET + 1))
 
         # Two more bid on 1st player
         bid_result = accept_bid(bid, User.query_first(username='pp'), 1200)
@@ -599,6 +750,7 @@ class BidTest(unittest.TestCase):
         # Check bids view
         bids = bids_view()
         self.assertEqual(5, len(bids))
+        self.assertTrue(all(bid.complete for bid in bids))
         self.assertEqual('Jasprit Bumrah', bids[0].player_name)
         test_usernames = ['nz', 'pp', 'rg', 'sa']
         db_usernames = [bd['username'] for bd in bids[0].bid_map]
@@ -606,7 +758,7 @@ class BidTest(unittest.TestCase):
 
         # Check paginated bids view
         page = bids_view(3)
-        page = bids_view(page.per_page, end=page.current_end.doc_id)
+        page = bids_view(page.per_page, cursor=page.next_cursor)
         self.assertEqual('Rohit Sharma', page.items[0].player_name)
         db_usernames = [bd['username'] for bd in page.items[0].bid_map]
         self.assertListEqual(test_usernames, db_usernames)
@@ -652,6 +804,27 @@ class UploadTest(unittest.TestCase):
         self.assertEqual(Upload.ERROR_FILE_NOT_FOUND, upload_data('test'))
         Upload.ACCEPTED_TYPES.pop()
 
+    def test_upload_users_workers(self):
+        rows = [['username', 'name', 'password', 'color', 'bg_color']]
+        rows += [[f'w{index}', f'Worker {index}', f'pass{index}', 'Black', 'White'] for index in range(5)]
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as csv_file:
+            csv.writer(csv_file).writerows(rows)
+        self.upload_data.file_name = csv_file.name
+        self.upload_data.workers = 2
+        try:
+            self.assertEqual(Upload.SUCCESS, self.upload_data('users'))
+        finally:
+            os.remove(csv_file.name)
+        self.assertEqual(2, self.upload_data.stats['workers'])
+        self.assertEqual(5, self.upload_data.stats['users'])
+        # The hashes from the spawned workers are matched to their users
+        for index in range(5):
+            user = User.read(f'w{index}')
+            self.assertTrue(user.check_password(f'pass{index}'))
+            self.assertFalse(user.check_password(f'pass{(index + 1) % 5}'))
+            self.assertEqual('black', user.color)
+        self.assertEqual(5, Game.read().user_count)
+
     def test_upload_players(self):
         result = self.upload_data('players')
         self.assertEqual(Upload.SUCCESS, result)
@@ -668,7 +841,7 @@ class UploadTest(unittest.TestCase):
         self.assertEqual(25, len(page.items))
         self.assertTrue(page.has_next)
         self.assertFalse(page.has_prev)
-        page = available_players_view(page.per_page, end=page.current_end.doc_id, direction=FirestorePage.NEXT_PAGE)
+        page = available_players_view(page.per_page, cursor=page.next_cursor, direction=FirestorePage.NEXT_PAGE)
         self.assertEqual(26, page.current_start.bid_order)
         self.assertEqual(50, page.current_end.bid_order)
         self.assertEqual(25, len(page.items))
@@ -676,14 +849,14 @@ class UploadTest(unittest.TestCase):
         self.assertTrue(page.has_prev)
         # Go to the end
         for _ in range(4):
-            page = available_players_view(page.per_page, end=page.current_end.doc_id, direction=FirestorePage.NEXT_PAGE)
+            page = available_players_view(page.per_page, cursor=page.next_cursor, direction=FirestorePage.NEXT_PAGE)
         self.assertEqual(126, page.current_start.bid_order)
         self.assertEqual(150, page.current_end.bid_order)
         self.assertEqual(25, len(page.items))
         self.assertFalse(page.has_next)
         self.assertTrue(page.has_prev)
         # Test previous page
-        page = available_players_view(page.per_page, start=page.current_start.doc_id, direction=FirestorePage.PREV_PAGE)
+        page = available_players_view(page.per_page, cursor=page.prev_cursor, direction=FirestorePage.PREV_PAGE)
         self.assertEqual(101, page.current_start.bid_order)
         self.assertEqual(125, page.current_end.bid_order)
         self.assertEqual(25, len(page.items))
@@ -691,14 +864,14 @@ class UploadTest(unittest.TestCase):
         self.assertTrue(page.has_prev)
         # Go back to the start
         for _ in range(4):
-            page = available_players_view(page.per_page, start=page.current_start.doc_id, direction=FirestorePage.PREV_PAGE)
+            page = available_players_view(page.per_page, cursor=page.prev_cursor, direction=FirestorePage.PREV_PAGE)
         self.assertEqual(1, page.current_start.bid_order)
         self.assertEqual(25, page.current_end.bid_order)
         self.assertEqual(25, len(page.items))
         self.assertTrue(page.has_next)
         self.assertFalse(page.has_prev)
         # Going beyond start will give you none
-        page = available_players_view(page.per_page, start=page.current_start.doc_id, direction=FirestorePage.PREV_PAGE)
+        page = available_players_view(page.per_page, cursor=page.prev_cursor, direction=FirestorePage.PREV_PAGE)
         self.assertIsNone(page)
 
         # Test player stats
@@ -725,6 +898,52 @@ class UploadTest(unittest.TestCase):
         players = search_players_view(tags)['players']
         self.assertEqual(30, len(players), f'{tags}')
 
+    def test_upload_players_upsert(self):
+        self.assertEqual(Upload.SUCCESS, self.upload_data('players'))
+        upload_data = Upload()
+        upload_data.upsert = True
+        upload_data.dry_run = True
+        self.assertEqual(Upload.SUCCESS, upload_data('players'))
+        self.assertEqual(150, upload_data.report['unchanged'])
+        self.assertListEqual(list(), upload_data.report['added'] + upload_data.report['changed'])
+        self.assertListEqual(list(), upload_data.report['removed'])
+        # A file with a player added, changed and removed. A removed player who is purchased is kept.
+        with open('players.csv') as csv_file:
+            rows = list(csv.reader(csv_file))
+        changed, removed, kept = rows[1], rows[2], rows[3]
+        Player.read(Player.name_to_id(kept[0])).update_fields(status=Player.PURCHASED)
+        changed[3] += ';upsert'
+        added = list(changed)
+        added[0] = 'Upsert Player'
+        rows = [row for row in rows if row not in (removed, kept)] + [added]
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as csv_file:
+            csv.writer(csv_file).writerows(rows)
+        upload_data = Upload()
+        upload_data.file_name = csv_file.name
+        upload_data.upsert = True
+        upload_data.dry_run = True
+        try:
+            self.assertEqual(Upload.SUCCESS, upload_data('players'))
+            self.assertListEqual(['Upsert Player'], upload_data.report['added'])
+            self.assertListEqual([changed[0]], upload_data.report['changed'])
+            self.assertListEqual([removed[0]], upload_data.report['removed'])
+            self.assertListEqual([kept[0]], upload_data.report['kept'])
+            self.assertEqual(147, upload_data.report['unchanged'])
+            self.assertIsNone(Player.read(Player.name_to_id('Upsert Player')))
+            self.assertNotIn('upsert', Player.read(Player.name_to_id(changed[0])).tags)
+            upload_data.dry_run = False
+            self.assertEqual(Upload.SUCCESS, upload_data('players'))
+        finally:
+            os.remove(csv_file.name)
+        self.assertIsNotNone(Player.read(Player.name_to_id('Upsert Player')))
+        player = Player.read(Player.name_to_id(changed[0]))
+        self.assertIn('upsert', player.tags)
+        self.assertEqual(Player.AVAILABLE, player.status)
+        self.assertIsNone(Player.read(Player.name_to_id(removed[0])))
+        self.assertEqual(Player.PURCHASED, Player.read(Player.name_to_id(kept[0])).status)
+        self.assertEqual(150, len(Player.get_all()))
+        self.assertEqual(Upload.SUCCESS, self.upload_data('players'))
+
     def test_upload_scores(self):
         result = self.upload_data('scores')
         self.assertEqual(Upload.SUCCESS, result, result)
@@ -793,3 +1012,342 @@ class DownloadTest(unittest.TestCase):
         download_data()
         self.assertTrue(os.path.isfile(download_data.file_name))
 
+    def test_download_delta(self):
+        folder = tempfile.mkdtemp()
+        download_data = Download(os.path.join(folder, 'wc.json'), os.path.join(folder, 'wc-delta.jsonl'))
+        download_data()
+        self.assertEqual(0, download_data.delta())
+        player = Player('Delta Player')
+        player.score = 12.5
+        player.create()
+        self.assertEqual(1, download_data.delta())
+        download_data.compact()
+        with open(download_data.file_name) as json_file:
+            data = json.load(json_file)
+        self.assertIn(player.to_dict(), data['player'])
+        player.delete()
+
+    def test_download_snapshot(self):
+        folder = tempfile.mkdtemp()
+        download_data = Download(os.path.join(folder, 'wc.snap'), os.path.join(folder, 'wc-delta.jsonl'))
+        download_data()
+        data = download_data.read()
+        self.assertEqual(len(User.get_all()), len(data['user']))
+        self.assertEqual(Upload.SUCCESS, Upload.upload_all(download_data.file_name))
+        self.assertEqual(len(data['player']), len(Player.get_all()))
+
+    def test_upload_corrupt_snapshot(self):
+        folder = tempfile.mkdtemp()
+        download_data = Download(os.path.join(folder, 'wc.snap'), os.path.join(folder, 'wc-delta.jsonl'))
+        download_data()
+        with open(download_data.file_name, 'rb') as snapshot_file:
+            content = snapshot_file.read()
+        users, players = len(User.get_all()), len(Player.get_all())
+        game = Game.read()
+        corrupt_file_name = os.path.join(folder, 'corrupt.snap')
+        # Cut near the end so that the records of the first collections can be read
+        with open(corrupt_file_name, 'wb') as snapshot_file:
+            snapshot_file.write(content[:-20])
+        self.assertEqual(Upload.ERROR_INVALID_HEADER, Upload.upload_all(corrupt_file_name))
+        self.assertEqual(users, len(User.get_all()))
+        self.assertEqual(players, len(Player.get_all()))
+        self.assertEqual(game.revision, Game.read().revision)
+
+    def test_last_updated(self):
+        player = Player('Updated Player')
+        player.owner_username = 'lu'
+        player.create()
+        self.assertIsNotNone(Player.last_updated(player.doc_id))
+        self.assertEqual(Player.last_updated(player.doc_id), Player.last_updated(owner_username='lu'))
+        self.assertIsNone(Player.last_updated(owner_username='no owner'))
+        player.delete()
+
+    def test_replica(self):
+        User.delete_all()
+        Player.delete_all()
+        Game.delete_all()
+        Bid.delete_all()
+        # Users and players that tie on the fields of the order
+        for username, points, balance in [('ra', 0, 10000), ('rb', 0, 10000), ('rc', 10, 9000), ('rd', 10, 9000),
+                                          ('re', 10, 8000), ('rf', 0, 10000)]:
+            User.from_dict({'username': username, 'name': username, 'points': points, 'balance': balance}).create()
+        for name, bid_order in [('Replica One', 1), ('Replica Two', 2), ('Replica Three', 2), ('Replica Four', 3)]:
+            Player.from_dict({'name': name, 'bid_order': bid_order}).create()
+        Game.init_game()
+        folder = tempfile.mkdtemp()
+        Download(os.path.join(folder, 'wc.json'), os.path.join(folder, 'wc-delta.jsonl'))()
+        replica = Replica(os.path.join(folder, 'wc.json'), os.path.join(folder, 'wc-delta.jsonl')).load()
+        self.assertListEqual([user.username for user in ranked_users_view()],
+                             [user.username for user in replica.ranked_users_view()])
+        self.assertListEqual(['rd', 'rc', 're', 'rf', 'rb', 'ra'],
+                             [user.username for user in replica.ranked_users_view()])
+        self.assertListEqual([player.doc_id for player in available_players_view()],
+                             [player.doc_id for player in replica.available_players_view()])
+        player = Player('Replica Player')
+        player.create()
+        self.assertIsNone(replica.player_view(player.doc_id))
+        self.assertEqual(1, replica.refresh())
+        self.assertEqual(player.name, replica.player_view(player.doc_id).name)
+        player.delete()
+
+
+class InstrumentationTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+
+    def tearDown(self) -> None:
+        self.app_context.pop()
+
+    def test_request_log(self):
+        response = self.client.get('/auth/login')
+        self.assertEqual(200, response.status_code)
+        self.assertRegex(response.headers[instrumentation.STATS_HEADER], r'^calls=\d+; bytes=\d+; time=[\d.]+ms$')
+        self.app.config['REQUEST_LOG'] = Config.REQUEST_LOG
+        response = self.client.get('/auth/login')
+        self.assertEqual(200, response.status_code)
+        self.assertNotIn(instrumentation.STATS_HEADER, response.headers)
+
+    def test_metrics(self):
+        self.app.config['METRICS_TOKEN'] = 'metrics-token'
+        remote = {'REMOTE_ADDR': '10.0.0.1'}
+        self.assertEqual(403, self.client.get('/metrics', environ_base=remote).status_code)
+        headers = {'Authorization': 'Bearer wrong-token'}
+        self.assertEqual(403, self.client.get('/metrics', environ_base=remote, headers=headers).status_code)
+        headers = {'Authorization': 'Bearer metrics-token'}
+        response = self.client.get('/metrics', environ_base=remote, headers=headers)
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'wc_requests_total', response.data)
+        response = self.client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        self.assertEqual(200, response.status_code)
+        # Without a token only the allowed addresses are served
+        self.app.config['METRICS_TOKEN'] = None
+        headers = {'Authorization': 'Bearer None'}
+        self.assertEqual(403, self.client.get('/metrics', environ_base=remote, headers=headers).status_code)
+
+
+class HttpCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.user = User(name='Http Cache', username='hc').create()
+        self.player = Player('Http Cache Player').create()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = self.user.username
+
+    def tearDown(self) -> None:
+        self.player.delete()
+        self.user.delete()
+        self.app_context.pop()
+
+    def test_not_modified(self):
+        url = f'/players/{self.player.doc_id}'
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        etag = response.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        self.assertIsNotNone(response.last_modified)
+        self.assertTrue(response.cache_control.private)
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response.headers.get('ETag'))
+        self.assertEqual(b'', response.data)
+        # A flash message is shown once. The page is rendered again.
+        with self.client.session_transaction() as session:
+            session['_flashes'] = [('message', 'Flash')]
+        self.assertEqual(200, self.client.get(url, headers={'If-None-Match': etag}).status_code)
+
+
+class CompressionTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = create_app(TestConfig)
+        self.body = 'compress ' * 100
+
+        def page(size):
+            response = Response(self.body[:size], mimetype='text/html')
+            response.set_etag('page')
+            return response
+
+        def encoded():
+            data = gzip.compress(self.body.encode())
+            return Response(data, mimetype='text/html', headers={'Content-Encoding': 'gzip'})
+
+        def streamed():
+            return Response((line for line in [self.body]), mimetype='text/html')
+
+        self.app.add_url_rule('/test/page/<int:size>', 'test_page', page)
+        self.app.add_url_rule('/test/encoded', 'test_encoded', encoded)
+        self.app.add_url_rule('/test/streamed', 'test_streamed', streamed)
+        self.client = self.app.test_client()
+
+    def test_min_size(self):
+        size = self.app.config['COMPRESS_MIN_SIZE']
+        response = self.client.get(f'/test/page/{size - 1}', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('Accept-Encoding', response.vary)
+        self.assertEqual(self.body[:size - 1].encode(), response.data)
+        response = self.client.get(f'/test/page/{size}', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', response.headers.get('Content-Encoding'))
+        self.assertEqual(self.body[:size].encode(), gzip.decompress(response.data))
+
+    def test_encoding(self):
+        url = f'/test/page/{len(self.body)}'
+        response = self.client.get(url)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(('page', False), response.get_etag())
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip;q=1.0, br;q=0.5'})
+        self.assertEqual('gzip', response.headers.get('Content-Encoding'))
+        self.assertIn('Accept-Encoding', response.vary)
+        # The compressed page has a weak etag
+        self.assertEqual(('page', True), response.get_etag())
+        response = self.client.get(url, headers={'Accept-Encoding': 'br;q=1.0, gzip;q=0.5'})
+        if compression.brotli:
+            self.assertEqual('br', response.headers.get('Content-Encoding'))
+            self.assertEqual(self.body.encode(), compression.brotli.decompress(response.data))
+        else:
+            self.assertEqual('gzip', response.headers.get('Content-Encoding'))
+        self.assertEqual(('page', True), response.get_etag())
+
+    def test_skipped(self):
+        response = self.client.get('/test/encoded', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', response.headers.get('Content-Encoding'))
+        self.assertEqual(self.body.encode(), gzip.decompress(response.data))
+        response = self.client.get('/test/streamed', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(self.body.encode(), response.data)
+
+
+class FragmentTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = create_app(TestConfig)
+        self.request_context = self.app.test_request_context()
+        self.request_context.push()
+        g.game = Game()
+        g.game.revision = Game.new_revision()
+
+    def tearDown(self) -> None:
+        self.request_context.pop()
+
+    def render(self, fragments, key='available'):
+        return fragments.render('_available_table.html', (key,), players=list())
+
+    def test_fragment_cache(self):
+        fragments = FragmentCache(100000)
+        html = self.render(fragments)
+        self.assertIn(('_available_table.html', 'available'), fragments.cache)
+        # A hit is not rendered again
+        fragments.cache[('_available_table.html', 'available')] = 'cached'
+        self.assertEqual('cached', self.render(fragments))
+        # A new revision clears the cache
+        g.game.revision = Game.new_revision()
+        self.assertEqual(html, self.render(fragments))
+        self.assertEqual(1, len(fragments.cache))
+
+    def test_fragment_cache_size(self):
+        html = self.render(FragmentCache(100000))
+        fragments = FragmentCache(len(html) - 1)
+        self.assertEqual(html, self.render(fragments))
+        self.assertEqual(0, len(fragments.cache))
+        fragments = FragmentCache(len(html) * 2 - 1)
+        self.render(fragments, 'first')
+        self.render(fragments, 'second')
+        self.assertListEqual([('_available_table.html', 'second')], list(fragments.cache))
+        self.assertLessEqual(fragments.cache.currsize, fragments.cache.maxsize)
+
+
+class ThumbnailsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.static_folder, self.manifest_file = Thumbnails.STATIC_FOLDER, Thumbnails.MANIFEST_FILE
+        Thumbnails.STATIC_FOLDER = self.folder
+        Thumbnails.MANIFEST_FILE = os.path.join(self.folder, 'image-manifest.json')
+        Thumbnails._manifest_time = None
+
+    def tearDown(self) -> None:
+        Thumbnails.STATIC_FOLDER, Thumbnails.MANIFEST_FILE = self.static_folder, self.manifest_file
+        Thumbnails._manifest_time = None
+
+    def write_manifest(self, manifest, modified):
+        with open(Thumbnails.MANIFEST_FILE, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.utime(Thumbnails.MANIFEST_FILE, (modified, modified))
+
+    def test_file_name(self):
+        self.assertIsNone(Thumbnails.file_name('virat_kohli', 'profile'))
+        self.write_manifest({'virat_kohli': {'profile': 'images/virat_kohli.profile.1.jpg'}}, 1000)
+        self.assertEqual('images/virat_kohli.profile.1.jpg', Thumbnails.file_name('virat_kohli', 'profile'))
+        self.assertIsNone(Thumbnails.file_name('virat_kohli', 'large'))
+        self.assertIsNone(Thumbnails.file_name('rohit_sharma', 'profile'))
+
+    def test_manifest_reload(self):
+        self.write_manifest({'virat_kohli': {'profile': 'images/virat_kohli.profile.1.jpg'}}, 1000)
+        self.assertEqual('images/virat_kohli.profile.1.jpg', Thumbnails.file_name('virat_kohli', 'profile'))
+        self.write_manifest({'virat_kohli': {'profile': 'images/virat_kohli.profile.2.jpg'}}, 2000)
+        self.assertEqual('images/virat_kohli.profile.2.jpg', Thumbnails.file_name('virat_kohli', 'profile'))
+
+    def test_image_file(self):
+        player = Player('Virat Kohli')
+        self.assertIsNone(player.image_file)
+        open(os.path.join(self.folder, player.doc_id + '.png'), 'wb').close()
+        self.assertEqual(player.doc_id + '.png', player.image_file)
+        self.write_manifest({player.doc_id: {'profile': f'images/{player.doc_id}.profile.1.jpg'}}, 1000)
+        self.assertEqual(f'images/{player.doc_id}.profile.1.jpg', player.image_file)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.file_name = os.path.join(tempfile.mkdtemp(), 'wc.snap')
+        self.data = {
+            'game': [{'user_count': 2, 'player_in_bidding': None}],
+            'user': [{'username': 'aa', 'balance': 1000}, {'username': 'bb', 'balance': 0}],
+            'bid': list(),
+        }
+
+    def test_round_trip(self):
+        write_snapshot(self.file_name, self.data)
+        self.assertDictEqual(self.data, load_snapshot(self.file_name))
+        records = list(read_snapshot(self.file_name))
+        self.assertEqual(('game', None), records[0])
+        self.assertEqual(('bid', None), records[-1])
+        self.assertEqual(len(self.data['game']) + len(self.data['user']) + len(self.data), len(records))
+
+    def test_is_snapshot(self):
+        self.assertTrue(is_snapshot('wc.snap'))
+        self.assertFalse(is_snapshot('wc.json'))
+        self.assertFalse(is_snapshot('wc.snap.json'))
+
+    def test_bad_header(self):
+        with gzip.open(self.file_name, 'wb') as snapshot_file:
+            snapshot_file.write(b'{"game": []}')
+        with self.assertRaises(ValueError):
+            load_snapshot(self.file_name)
+        with gzip.open(self.file_name, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(b'WCSNAP', 99))
+        with self.assertRaises(ValueError):
+            load_snapshot(self.file_name)
+
+    def test_corrupt(self):
+        write_snapshot(self.file_name, self.data)
+        with open(self.file_name, 'rb') as snapshot_file:
+            content = snapshot_file.read()
+        middle = len(content) // 2
+        for corrupt in (content[:-10], content[:middle] + bytes(byte ^ 0xff for byte in content[middle:middle + 8])
+                        + content[middle + 8:]):
+            with open(self.file_name, 'wb') as snapshot_file:
+                snapshot_file.write(corrupt)
+            with self.assertRaises(ValueError):
+                load_snapshot(self.file_name)
+
+    def test_truncated(self):
+        write_snapshot(self.file_name, self.data)
+        with gzip.open(self.file_name, 'rb') as snapshot_file:
+            content = snapshot_file.read()
+        for size in (HEADER.size - 1, HEADER.size + 2, len(content) - 1):
+            with gzip.open(self.file_name, 'wb') as snapshot_file:
+                snapshot_file.write(content[:size])
+            with self.assertRaises(ValueError):
+                load_snapshot(self.file_name)